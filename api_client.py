@@ -0,0 +1,85 @@
+import os
+import threading
+
+import httpx
+from openai import OpenAI
+
+# Connections kept to the API at most, and how many of them are kept open between requests.
+MAX_CONNECTIONS = int(os.getenv("TTS_MAX_CONNECTIONS", "16"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("TTS_MAX_KEEPALIVE_CONNECTIONS", "16"))
+# Seconds an idle connection is kept open.
+KEEPALIVE_EXPIRY = float(os.getenv("TTS_KEEPALIVE_EXPIRY", "60"))
+# Seconds allowed to connect, and between two pieces of a response.
+CONNECT_TIMEOUT = float(os.getenv("TTS_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("TTS_READ_TIMEOUT", "120"))
+
+
+class ConnectionStats:
+    """
+    Counts the requests sent through the shared client and the connections opened for
+    them, to show how often a kept-alive connection was reused.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def on_request(self, request):
+        with self._lock:
+            self.requests += 1
+        # httpcore reports each step of the request to the trace extension, including
+        # when it has to open a new connection rather than reuse one from the pool.
+        request.extensions["trace"] = self._trace
+
+    def _trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.connections += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {"requests": self.requests, "connections": self.connections,
+                    "reused": max(self.requests - self.connections, 0)}
+
+    def summary(self):
+        stats = self.as_dict()
+        return (f"Connections: {stats['requests']} requests over {stats['connections']} "
+                f"connections, {stats['reused']} reused")
+
+
+connection_stats = ConnectionStats()
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the OpenAI client shared by every conversion, estimate and preview in the
+    process, creating it on first use.
+
+    The client keeps a pool of up to MAX_CONNECTIONS connections alive between
+    requests, so repeated and concurrent jobs skip the connection and TLS setup. Its
+    own retries are turned off because RequestScheduler retries requests. Like any
+    OpenAI client it reads OPENAI_API_KEY and OPENAI_BASE_URL, so it can be pointed at
+    mock_tts_server.py.
+
+    The pool and timeouts are set with TTS_MAX_CONNECTIONS, TTS_MAX_KEEPALIVE_CONNECTIONS,
+    TTS_KEEPALIVE_EXPIRY, TTS_CONNECT_TIMEOUT and TTS_READ_TIMEOUT.
+
+    Returns:
+    - OpenAI: The shared client.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            timeout = httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                                    keepalive_expiry=KEEPALIVE_EXPIRY),
+                timeout=timeout,
+                event_hooks={"request": [connection_stats.on_request]})
+            _client = OpenAI(max_retries=0, timeout=timeout, http_client=http_client)
+        return _client
@@ -1,23 +1,47 @@
+import os
+import queue
+import shutil
 import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import threading
 import tkinter as tk
 from tkinter import PhotoImage, ttk, filedialog
 from playsound import playsound
 
-from main import gen_audio, get_price
+from audio import OUTPUT_FORMATS
+from batch import convert_chapters
+from main import PREVIEW_SECONDS, gen_audio, get_estimate, preview_audio
+from tts_backends import BACKENDS
+
+
+# How often, in milliseconds, the window checks for progress from the background work.
+POLL_INTERVAL_MS = 100
 
 
 class PDFtoMP3Converter:
     def __init__(self):
         self.root = tk.Tk()
+        # Conversions and estimates run here so the window stays responsive. They
+        # report back through self.events, which only the Tk thread reads.
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+        self._progress = None
+        # Characters to convert in each page range estimated so far, by _range_key.
+        self._totals = {}
+        self.preview_chunks = None
         self._configure_root()
         self._create_widgets()
+        self.root.protocol("WM_DELETE_WINDOW", self._close)
+        self.root.after(POLL_INTERVAL_MS, self._poll_events)
         self.root.mainloop()
 
     def _configure_root(self):
         self.root.title("PDF to MP3 Converter")
-        self.root.geometry("585x400")
+        self.root.geometry("585x700")
         # self.root.resizable(False, False)
         self.root.tk.call("source", "Azure-ttk-theme/azure.tcl")
         self.root.tk.call("set_theme", "dark")
@@ -39,12 +63,18 @@ class PDFtoMP3Converter:
         folder_button = ttk.Button(
             self.root, text="Browse", command=self._select_folder)
 
-        options = ['alloy', 'echo', 'fable', 'onyx', 'nova', 'shimmer']
+        self.backend_var = tk.StringVar(value="openai")
+        backend_label = ttk.Label(self.root, text="Speech engine:")
+        backend_dropdown = ttk.Combobox(self.root, values=list(BACKENDS), state="readonly",
+                                        textvariable=self.backend_var)
+        backend_dropdown.bind("<<ComboboxSelected>>", self._select_backend)
+
+        options = list(BACKENDS["openai"].voices)
         self.options_var = tk.StringVar(value=options)
         dropdown_label = ttk.Label(self.root, text="Select a voice:")
-        dropdown = ttk.Combobox(self.root, values=options,
-                                textvariable=self.options_var)
-        dropdown.set("alloy")
+        self.voice_dropdown = ttk.Combobox(self.root, values=options,
+                                           textvariable=self.options_var)
+        self.voice_dropdown.set("alloy")
 
         # photo = PhotoImage(file="assets/play30.png")
         play_sound_button_label = ttk.Label(self.root, text="Play sample:")
@@ -61,14 +91,39 @@ class PDFtoMP3Converter:
             self.root.register(self._validate_positive_integer), "%P"))
 
         output_file_label = ttk.Label(
-            self.root, text="Output MP3 file name (no file ext):")
+            self.root, text="Output file name (no file ext):")
         self.output_file_entry = ttk.Entry(self.root)
 
-        estimate_price_button = ttk.Button(
+        self.format_var = tk.StringVar(value="mp3")
+        format_label = ttk.Label(self.root, text="Audio format:")
+        format_dropdown = ttk.Combobox(self.root, values=list(OUTPUT_FORMATS), state="readonly",
+                                       textvariable=self.format_var)
+        self.split_chapters = tk.BooleanVar(value=False)
+        split_chapters_check = ttk.Checkbutton(
+            self.root, text="One file per chapter, with a playlist",
+            variable=self.split_chapters)
+
+        self.estimate_price_button = ttk.Button(
             self.root, text="Estimate Price", command=self._estimate_price)
-        generate_button = ttk.Button(
+        self.generate_button = ttk.Button(
             self.root, text="Generate", command=self._generate)
 
+        self.progress_bar = ttk.Progressbar(
+            self.root, orient="horizontal", mode="determinate", maximum=100)
+        self.status_text = tk.StringVar(value="")
+        status_label = ttk.Label(self.root, textvariable=self.status_text)
+        self.cancel_button = ttk.Button(
+            self.root, text="Cancel", command=self._cancel, state="disabled")
+
+        preview_label = ttk.Label(
+            self.root, text=f"Preview the first {PREVIEW_SECONDS} seconds:")
+        self.preview_button = ttk.Button(
+            self.root, text="Preview", command=self._preview)
+        self.play_while_generating = tk.BooleanVar(value=False)
+        play_while_generating_check = ttk.Checkbutton(
+            self.root, text="Play chunks while generating",
+            variable=self.play_while_generating)
+
         # Layout configuration
         file_label.grid(row=1, column=0, padx=10, pady=5, sticky="w")
         file_button.grid(row=1, column=1, padx=10, pady=5, sticky="e")
@@ -76,24 +131,42 @@ class PDFtoMP3Converter:
         folder_label.grid(row=2, column=0, padx=10, pady=5, sticky="w")
         folder_button.grid(row=2, column=1, padx=10, pady=5, sticky="e")
 
-        dropdown_label.grid(row=3, column=0, padx=10, pady=5, sticky="w")
-        dropdown.grid(row=3, column=1, padx=10, pady=5)
+        backend_label.grid(row=3, column=0, padx=10, pady=5, sticky="w")
+        backend_dropdown.grid(row=3, column=1, padx=10, pady=5)
+
+        dropdown_label.grid(row=4, column=0, padx=10, pady=5, sticky="w")
+        self.voice_dropdown.grid(row=4, column=1, padx=10, pady=5)
 
         play_sound_button_label.grid(
-            row=4, column=0, padx=10, pady=5, sticky="w")
-        play_sound_button.grid(row=4, column=1, padx=10, sticky="e")
+            row=5, column=0, padx=10, pady=5, sticky="w")
+        play_sound_button.grid(row=5, column=1, padx=10, sticky="e")
 
-        start_page_label.grid(row=5, column=0, padx=10, pady=5, sticky="w")
-        self.start_page_entry.grid(row=5, column=1, padx=10, pady=5)
+        start_page_label.grid(row=6, column=0, padx=10, pady=5, sticky="w")
+        self.start_page_entry.grid(row=6, column=1, padx=10, pady=5)
 
-        end_page_label.grid(row=6, column=0, padx=10, pady=5, sticky="w")
-        self.end_page_entry.grid(row=6, column=1, padx=10, pady=5)
+        end_page_label.grid(row=7, column=0, padx=10, pady=5, sticky="w")
+        self.end_page_entry.grid(row=7, column=1, padx=10, pady=5)
 
-        output_file_label.grid(row=7, column=0, padx=10, pady=5, sticky="w")
-        self.output_file_entry.grid(row=7, column=1, padx=10, pady=5)
+        output_file_label.grid(row=8, column=0, padx=10, pady=5, sticky="w")
+        self.output_file_entry.grid(row=8, column=1, padx=10, pady=5)
 
-        estimate_price_button.grid(row=8, column=0, padx=10, pady=10)
-        generate_button.grid(row=8, column=1, columnspan=2, padx=10, pady=10)
+        format_label.grid(row=9, column=0, padx=10, pady=5, sticky="w")
+        format_dropdown.grid(row=9, column=1, padx=10, pady=5)
+
+        split_chapters_check.grid(row=10, column=0, columnspan=2, padx=10, pady=5,
+                                  sticky="w")
+
+        self.estimate_price_button.grid(row=11, column=0, padx=10, pady=10)
+        self.generate_button.grid(row=11, column=1, columnspan=2, padx=10, pady=10)
+
+        self.progress_bar.grid(row=12, column=0, columnspan=2, padx=10, pady=5, sticky="we")
+        status_label.grid(row=13, column=0, padx=10, pady=5, sticky="w")
+        self.cancel_button.grid(row=13, column=1, padx=10, pady=5, sticky="e")
+
+        preview_label.grid(row=14, column=0, padx=10, pady=5, sticky="w")
+        self.preview_button.grid(row=14, column=1, padx=10, pady=5, sticky="e")
+        play_while_generating_check.grid(row=15, column=0, columnspan=2, padx=10, pady=5,
+                                         sticky="w")
 
     def display_message(self, message):
         # Create a new window
@@ -137,13 +210,58 @@ class PDFtoMP3Converter:
             self.full_folder_path = folder_path
         self.root.tk.call("set_theme", "dark")
 
+    def _select_backend(self, event=None):
+        voices = BACKENDS[self.backend_var.get()].voices
+        self.voice_dropdown.config(values=list(voices))
+        self.voice_dropdown.set(voices[0])
+
     def _play(self):
         voice = self.options_var.get()
+        sample_path = f"assets/samples/{voice}.mp3"
+        if not os.path.exists(sample_path):
+            self.display_message("There is no sample of this voice. Use Preview to hear it.")
+            return
         def play_anon(mp3File): playsound(mp3File)
-        t1 = threading.Thread(target=play_anon, args=(
-            f"assets/samples/{voice}.mp3", ))
+        t1 = threading.Thread(target=play_anon, args=(sample_path, ))
         t1.start()
 
+    def _preview(self):
+        self.preview_button.config(state="disabled")
+        self.executor.submit(
+            self._run_preview, self.full_file_path, int(self.start_page_entry.get()),
+            int(self.end_page_entry.get()), self.options_var.get(), self.backend_var.get())
+
+    def _run_preview(self, pdf_path, start_page, end_page, voice, backend):
+        # Each preview gets its own file, so previews started together never overwrite
+        # each other's audio.
+        with tempfile.NamedTemporaryFile(prefix="pdf_to_mp3_preview_", suffix=".mp3",
+                                         delete=False) as preview_file:
+            preview_path = preview_file.name
+        try:
+            preview_audio(pdf_path, start_page, end_page, preview_path, voice=voice,
+                          backend=backend)
+            self.events.put({"event": "preview_ready"})
+            playsound(preview_path)
+        except Exception as e:
+            self.events.put({"event": "preview_failed", "error": str(e)})
+        finally:
+            if os.path.exists(preview_path):
+                os.remove(preview_path)
+
+    def _play_chunks(self, chunks, preview_dir):
+        """
+        Plays chunk previews from chunks, in order, until it receives None or the
+        conversion is cancelled.
+        """
+        try:
+            while True:
+                path = chunks.get()
+                if path is None or self.cancel_event.is_set():
+                    break
+                playsound(path)
+        finally:
+            shutil.rmtree(preview_dir, ignore_errors=True)
+
     def _validate_positive_integer(self, P):
         return str.isdigit(P) or P == ""
 
@@ -156,12 +274,165 @@ class PDFtoMP3Converter:
             "end_page": self.end_page_entry.get(),
             "output_file_name": self.output_file_entry.get(),
         }
+        start_page, end_page = int(form_values["start_page"]), int(form_values["end_page"])
+        self.cancel_event.clear()
+        self.generate_button.config(state="disabled")
+        self.cancel_button.config(state="normal")
+        self.progress_bar["value"] = 0
+        self.status_text.set("Preparing...")
+        key = self._range_key(self.full_file_path, start_page, end_page)
+        self._progress = {"key": key, "total": self._totals.get(key), "done": 0, "new": 0,
+                          "start": time.monotonic()}
+        if self._progress["total"] is None:
+            # Counting the characters reads every page, so it runs alongside the
+            # conversion instead of holding up its first audio.
+            self.executor.submit(self._run_total, self.full_file_path, start_page, end_page,
+                                 key)
+        preview_dir = None
+        self.preview_chunks = None
+        split_chapters = self.split_chapters.get()
+        # Chapters are converted side by side, so their chunks do not finish in order.
+        if self.play_while_generating.get() and not split_chapters:
+            # Finished chunks are played in order while the rest are synthesized.
+            preview_dir = tempfile.mkdtemp(prefix="pdf_to_mp3_")
+            self.preview_chunks = queue.Queue()
+            threading.Thread(target=self._play_chunks, args=(self.preview_chunks, preview_dir),
+                             daemon=True).start()
+        self.executor.submit(
+            self._run_generation, self.full_file_path, self.full_folder_path,
+            form_values["output_file_name"], start_page, end_page,
+            form_values["voice_selection"],
+            self.backend_var.get(), self.format_var.get(), preview_dir, split_chapters)
+
+    def _run_generation(self, pdf_path, folder_path, output_file_name, start_page, end_page,
+                        voice, backend, output_format, preview_dir=None, split_chapters=False):
+        """
+        Runs a conversion on the executor, reporting its progress to self.events. With
+        split_chapters, every chapter is saved to its own file as soon as it is done.
+        """
         try:
-            file = gen_audio(self.full_file_path, self.full_folder_path, form_values["output_file_name"], int(
-                form_values["start_page"]), int(form_values["end_page"]))
-            self.display_message(f"Generated audio saved to {file}")
+            if split_chapters:
+                result = convert_chapters(pdf_path, folder_path, output_file_name, start_page,
+                                          end_page, voice=voice, backend=backend,
+                                          output_format=output_format,
+                                          on_progress=self.events.put,
+                                          cancel_event=self.cancel_event)
+                failed = [chapter for chapter in result["chapters"] if "error" in chapter]
+                if failed:
+                    raise RuntimeError(f"{len(failed)} of {len(result['chapters'])} chapters "
+                                       f"failed, the first with: {failed[0]['error']}")
+                file = result["index"] or folder_path
+            else:
+                file = gen_audio(pdf_path, folder_path, output_file_name, start_page, end_page,
+                                 voice=voice, on_progress=self.events.put,
+                                 cancel_event=self.cancel_event, preview_dir=preview_dir,
+                                 backend=backend, output_format=output_format)
+            self.events.put({"event": "finished", "output": file})
         except Exception as e:
-            self.display_message(f"Failed to generate audio: {e}")
+            self.events.put({"event": "failed", "error": str(e)})
+
+    def _range_key(self, pdf_path, start_page, end_page):
+        return (pdf_path, os.path.getmtime(pdf_path), start_page, end_page)
+
+    def _run_total(self, pdf_path, start_page, end_page, key):
+        """
+        Counts the characters a conversion will write, to measure its progress against.
+        """
+        try:
+            # The estimate runs the same chunker, so it gives the total to measure against.
+            estimate = get_estimate(pdf_path, start_page, end_page)
+        except Exception:
+            # The conversion reports whatever went wrong; progress is shown without a
+            # percentage.
+            return
+        self.events.put({"event": "total", "key": key,
+                         "chars": estimate["characters"] + estimate["repeated_characters"]})
+
+    def _cancel(self):
+        self.cancel_event.set()
+        self.cancel_button.config(state="disabled")
+        self.status_text.set("Cancelling after the requests in flight...")
+
+    def _close(self):
+        # Requests in flight finish and are saved, so the conversion can be resumed.
+        self.cancel_event.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.root.destroy()
+
+    def _poll_events(self):
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            self._handle_event(event)
+        self.root.after(POLL_INTERVAL_MS, self._poll_events)
+
+    def _handle_event(self, event):
+        kind = event["event"]
+        if kind == "total":
+            self._totals[event["key"]] = event["chars"]
+            if self._progress is not None and self._progress["key"] == event["key"]:
+                self._progress["total"] = event["chars"]
+                self._show_progress()
+        elif kind == "start" and self._progress is not None:
+            if "job" in event:
+                # Each chapter reports what an earlier run already wrote of it.
+                self._progress["done"] += event["resumed_chars"]
+            else:
+                self._progress["done"] = event["resumed_chars"]
+                self._progress["start"] = time.monotonic()
+        elif kind == "chunk" and self._progress is not None:
+            self._progress["done"] += event["chars"]
+            self._progress["new"] += event["chars"]
+            self._show_progress()
+            if self.preview_chunks is not None and "preview_path" in event:
+                self.preview_chunks.put(event["preview_path"])
+        elif kind == "preview_ready":
+            self.preview_button.config(state="normal")
+        elif kind == "preview_failed":
+            self.preview_button.config(state="normal")
+            self.display_message(f"Failed to preview the audio: {event['error']}")
+        elif kind == "estimate":
+            estimate = event["estimate"]
+            self._totals[event["key"]] = estimate["characters"] + estimate["repeated_characters"]
+            self._show_estimate(estimate)
+        elif kind == "estimate_failed":
+            self.estimate_price_button.config(state="normal")
+            self.display_message(f"Failed to estimate the price: {event['error']}")
+        elif kind in ("finished", "failed"):
+            self._progress = None
+            if self.preview_chunks is not None:
+                # The player stops once it has played every chunk it was given.
+                self.preview_chunks.put(None)
+                self.preview_chunks = None
+            self.generate_button.config(state="normal")
+            self.cancel_button.config(state="disabled")
+            if kind == "finished":
+                self.progress_bar["value"] = 100
+                self.status_text.set("Done")
+                self.display_message(f"Generated audio saved to {event['output']}")
+            elif self.cancel_event.is_set():
+                self.status_text.set("Cancelled. Generate again to resume.")
+            else:
+                self.status_text.set("Failed")
+                self.display_message(f"Failed to generate audio: {event['error']}")
+
+    def _show_progress(self):
+        progress = self._progress
+        if progress["total"] is None:
+            # The total is still being counted.
+            self.status_text.set(f"{progress['done']:,} characters converted")
+            return
+        fraction = min(progress["done"] / progress["total"], 1) if progress["total"] else 1
+        self.progress_bar["value"] = fraction * 100
+        status = f"{fraction:.0%}"
+        elapsed = time.monotonic() - progress["start"]
+        if progress["new"] and elapsed > 0:
+            remaining = (progress["total"] - progress["done"]) / (progress["new"] / elapsed)
+            minutes, seconds = divmod(max(round(remaining), 0), 60)
+            status += f", about {minutes}m {seconds:02d}s left"
+        self.status_text.set(status)
 
     def _estimate_price(self):
         form_values = {
@@ -172,12 +443,28 @@ class PDFtoMP3Converter:
             "end_page": self.end_page_entry.get(),
             "output_file_name": self.output_file_entry.get(),
         }
-        total_price_cents = get_price(self.full_file_path, int(
-            form_values["start_page"]), int(form_values["end_page"]))
-        total_price_dollars = total_price_cents / 100
+        self.estimate_price_button.config(state="disabled")
+        self.executor.submit(self._run_estimate, self.full_file_path,
+                             int(form_values["start_page"]), int(form_values["end_page"]),
+                             self.backend_var.get())
+
+    def _run_estimate(self, pdf_path, start_page, end_page, backend):
+        try:
+            estimate = get_estimate(pdf_path, start_page, end_page, backend=backend)
+            self.events.put({"event": "estimate", "estimate": estimate,
+                             "key": self._range_key(pdf_path, start_page, end_page)})
+        except Exception as e:
+            self.events.put({"event": "estimate_failed", "error": str(e)})
+
+    def _show_estimate(self, estimate):
+        self.estimate_price_button.config(state="normal")
+        total_price_dollars = estimate["price_cents"] / 100
+        minutes = round(estimate["duration_seconds"] / 60)
 
         self.display_message(
-            f"Price estimate: ${f'{total_price_dollars:.5f}' if total_price_dollars < 1 else f'{total_price_dollars:.2f}'}")
+            f"Price estimate: ${f'{total_price_dollars:.5f}' if total_price_dollars < 1 else f'{total_price_dollars:.2f}'}\n"
+            f"{estimate['chunks']} requests, about {minutes // 60}h {minutes % 60}m of audio")
 
 
-app = PDFtoMP3Converter()
+if __name__ == "__main__":
+    app = PDFtoMP3Converter()
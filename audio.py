@@ -0,0 +1,329 @@
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import wave
+
+# The format chunks are synthesized in for each output format. MP3 and ADTS AAC
+# chunks can be joined as they are; the other outputs are encoded once from raw PCM.
+OUTPUT_FORMATS = {
+    "mp3": "mp3",
+    "aac": "aac",
+    "m4b": "aac",
+    "wav": "pcm",
+    "flac": "pcm",
+    "opus": "pcm",
+}
+# The speech API's raw PCM: 24 kHz, 16-bit signed little-endian samples, mono.
+PCM_SAMPLE_RATE = 24000
+PCM_SAMPLE_WIDTH = 2
+# Bitrate of Opus output. Speech stays clear well below music bitrates.
+OPUS_BITRATE = os.getenv("TTS_OPUS_BITRATE", "32k")
+
+# ffmpeg arguments that read the joined chunks, and that write each output format
+# from them in a single pass. M4B copies the AAC stream into the container as it is.
+_FFMPEG_INPUTS = {
+    "aac": ["-f", "aac"],
+    "pcm": ["-f", "s16le", "-ar", str(PCM_SAMPLE_RATE), "-ac", "1"],
+}
+_FFMPEG_OUTPUTS = {
+    "m4b": ["-c:a", "copy", "-bsf:a", "aac_adtstoasc", "-f", "mp4"],
+    "flac": ["-c:a", "flac", "-f", "flac"],
+    "opus": ["-c:a", "libopus", "-b:a", OPUS_BITRATE, "-application", "voip", "-f", "ogg"],
+}
+
+# Layer III bitrates in kbps, indexed by the header's bitrate bits.
+_BITRATES = {
+    "mpeg1": [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    "mpeg2": [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# Sample rates in Hz, indexed by the header's version bits and then its sample rate bits.
+_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG-1
+    2: [22050, 24000, 16000],  # MPEG-2
+    0: [11025, 12000, 8000],   # MPEG-2.5
+}
+
+
+def _id3v2_size(data):
+    """
+    Returns the length of the ID3v2 tag at the start of data, or 0 if there is none.
+    """
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def parse_frame_header(header):
+    """
+    Decodes a 4 byte MPEG audio Layer III frame header.
+
+    Returns:
+    - tuple: (frame length in bytes, samples per frame, sample rate), or None if the
+      bytes are not a valid Layer III header.
+    """
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = _BITRATES["mpeg1" if mpeg1 else "mpeg2"][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    samples = 1152 if mpeg1 else 576
+    length = samples // 8 * bitrate // sample_rate + padding
+    return length, samples, sample_rate
+
+
+def iter_frames(data):
+    """
+    Yields the offset, length, sample count and sample rate of every audio frame in an
+    MP3 file's contents, skipping a leading ID3v2 tag. Stops at the first bytes that are
+    not a frame, such as a trailing ID3v1 tag.
+    """
+    offset = _id3v2_size(data)
+    while offset + 4 <= len(data):
+        frame = parse_frame_header(data[offset:offset + 4])
+        if frame is None or offset + frame[0] > len(data):
+            return
+        length, samples, sample_rate = frame
+        yield offset, length, samples, sample_rate
+        offset += length
+
+
+def _is_info_frame(data, offset, length):
+    # Xing/Info headers sit in the first frame, just after the side information.
+    head = data[offset:offset + min(length, 64)]
+    return b"Xing" in head or b"Info" in head
+
+
+# ADTS sample rates in Hz, indexed by the header's sampling frequency bits.
+_ADTS_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000,
+                      11025, 8000, 7350]
+
+
+def iter_adts_frames(data):
+    """
+    Yields the offset, length, sample count and sample rate of every frame in an ADTS
+    AAC stream. Stops at the first bytes that are not a frame.
+    """
+    offset = 0
+    while offset + 7 <= len(data):
+        header = data[offset:offset + 7]
+        # A 12 bit sync word, then a layer that is always 0, unlike MPEG audio.
+        if header[0] != 0xFF or header[1] & 0xF6 != 0xF0:
+            return
+        sample_rate_index = (header[2] >> 2) & 0x0F
+        length = ((header[3] & 0x03) << 11) | (header[4] << 3) | (header[5] >> 5)
+        if sample_rate_index >= len(_ADTS_SAMPLE_RATES) or length < 7 \
+                or offset + length > len(data):
+            return
+        samples = 1024 * ((header[6] & 0x03) + 1)
+        yield offset, length, samples, _ADTS_SAMPLE_RATES[sample_rate_index]
+        offset += length
+
+
+def audio_frames(data):
+    """
+    Returns just the audio frames of an MP3 file's contents, without ID3 tags or a
+    Xing/Info header frame, which would describe only this one file once concatenated.
+    Data that does not start with recognisable frames is returned unchanged.
+    """
+    frames = iter_frames(data)
+    first = next(frames, None)
+    if first is None:
+        return data
+    start = first[0]
+    end = first[0] + first[1]
+    if _is_info_frame(data, first[0], first[1]):
+        start = end
+    for offset, length, _, _ in frames:
+        end = offset + length
+    return data[start:end]
+
+
+def duration(data):
+    """
+    Returns the length in seconds of the audio frames in an MP3 file's contents.
+    """
+    return sum(samples / sample_rate for _, _, samples, sample_rate in iter_frames(data))
+
+
+def audio_duration(data, audio_format="mp3"):
+    """
+    Returns the length in seconds of chunk audio in one of the formats chunks are
+    synthesized in: "mp3", "aac" (ADTS) or "pcm".
+    """
+    if audio_format == "mp3":
+        return duration(data)
+    if audio_format == "aac":
+        return sum(samples / sample_rate for _, _, samples, sample_rate in iter_adts_frames(data))
+    if audio_format == "pcm":
+        return len(data) / (PCM_SAMPLE_RATE * PCM_SAMPLE_WIDTH)
+    raise ValueError(f"Unknown audio format: {audio_format}")
+
+
+def append_mp3(output_file, mp3_path):
+    """
+    Appends the audio frames of an MP3 file to an open binary file, without decoding.
+
+    Returns:
+    - int: Number of bytes written.
+    """
+    with open(mp3_path, "rb") as file:
+        frames = audio_frames(file.read())
+    output_file.write(frames)
+    return len(frames)
+
+
+def append_audio(output_file, audio_path, audio_format="mp3"):
+    """
+    Appends one chunk's audio to an open binary file. MP3 frames are copied without
+    their tags (see append_mp3), and ADTS AAC frames and raw PCM are copied as they
+    are, since they join without any headers.
+
+    Returns:
+    - int: Number of bytes written.
+    """
+    if audio_format == "mp3":
+        return append_mp3(output_file, audio_path)
+    start = output_file.tell()
+    with open(audio_path, "rb") as file:
+        shutil.copyfileobj(file, output_file)
+    return output_file.tell() - start
+
+
+def write_wav(source_path, output_path, offset=0, length=None, block_size=1024 * 1024):
+    """
+    Writes raw PCM from the speech API as a WAV file, a block at a time.
+
+    Args:
+    - source_path (str): File holding the PCM samples.
+    - output_path (str): Where to save the WAV file.
+    - offset (int): Where the samples start in the source file.
+    - length (int): Bytes of samples to copy. Defaults to the rest of the file.
+    """
+    with open(source_path, "rb") as source, wave.open(output_path, "wb") as output:
+        output.setnchannels(1)
+        output.setsampwidth(PCM_SAMPLE_WIDTH)
+        output.setframerate(PCM_SAMPLE_RATE)
+        source.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            block = source.read(block_size if remaining is None else min(block_size, remaining))
+            if not block:
+                break
+            output.writeframes(block)
+            if remaining is not None:
+                remaining -= len(block)
+
+
+def _metadata_value(value):
+    return re.sub(r"([=;#\\\n])", r"\\\1", value)
+
+
+def encode_output(source_path, output_path, output_format, chapters=(), title=None):
+    """
+    Turns the joined chunk audio of a conversion into the final file in one pass.
+
+    MP3 and AAC outputs are the joined chunks themselves and are only moved. WAV
+    gets a header in front of the PCM samples. M4B copies the AAC stream into an MP4
+    audiobook container with chapter markers, and FLAC and Opus are encoded once from
+    the PCM samples, all with a single ffmpeg run.
+
+    Args:
+    - source_path (str): The joined chunk audio, in OUTPUT_FORMATS[output_format].
+      It is removed once the output has been written.
+    - output_path (str): Where to save the output.
+    - output_format (str): One of OUTPUT_FORMATS.
+    - chapters (list of dict): The "title", "start" and "end" in seconds of each
+      chapter, for M4B output.
+    - title (str): The audiobook's title, for M4B output.
+
+    Raises:
+    - RuntimeError: If ffmpeg is needed and not installed, or fails. The source file
+      is kept, so finishing the conversion can be tried again.
+    """
+    source_format = OUTPUT_FORMATS[output_format]
+    if output_format in ("mp3", "aac"):
+        shutil.move(source_path, output_path)
+        return
+    if output_format == "wav":
+        write_wav(source_path, output_path)
+        os.remove(source_path)
+        return
+
+    if shutil.which("ffmpeg") is None:
+        raise RuntimeError("ffmpeg is not installed")
+    command = ["ffmpeg", "-y", "-loglevel", "error", *_FFMPEG_INPUTS[source_format],
+               "-i", source_path]
+    metadata_path = None
+    if output_format == "m4b":
+        fd, metadata_path = tempfile.mkstemp(suffix=".txt")
+        with os.fdopen(fd, "w", encoding="utf-8") as metadata:
+            metadata.write(";FFMETADATA1\n")
+            if title:
+                metadata.write(f"title={_metadata_value(title)}\n")
+            for chapter in chapters:
+                metadata.write("[CHAPTER]\nTIMEBASE=1/1000\n"
+                               f"START={round(chapter['start'] * 1000)}\n"
+                               f"END={round(chapter['end'] * 1000)}\n"
+                               f"title={_metadata_value(chapter['title'])}\n")
+        command += ["-i", metadata_path, "-map", "0:a", "-map_metadata", "1",
+                    "-map_chapters", "1"]
+    command += [*_FFMPEG_OUTPUTS[output_format], output_path]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed: {result.stderr.strip()}")
+    finally:
+        if metadata_path is not None:
+            os.remove(metadata_path)
+    os.remove(source_path)
+
+
+def concat_mp3_frames(file_paths, output_file_path):
+    """
+    Concatenates MP3 files by copying their frame streams one file at a time. Nothing
+    is decoded or re-encoded, and memory use is bounded by the largest single file.
+    """
+    with open(output_file_path, "wb") as output_file:
+        for file_path in file_paths:
+            append_mp3(output_file, file_path)
+
+
+def concat_mp3_ffmpeg(file_paths, output_file_path):
+    """
+    Concatenates MP3 files in a single ffmpeg pass with the concat demuxer, copying
+    the audio stream instead of re-encoding it.
+
+    Raises:
+    - RuntimeError: If ffmpeg is not installed or fails.
+    """
+    if shutil.which("ffmpeg") is None:
+        raise RuntimeError("ffmpeg is not installed")
+
+    fd, list_path = tempfile.mkstemp(suffix=".txt")
+    try:
+        with os.fdopen(fd, "w") as list_file:
+            for file_path in file_paths:
+                escaped = os.path.abspath(file_path).replace("'", "'\\''")
+                list_file.write(f"file '{escaped}'\n")
+        result = subprocess.run(
+            ["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+             "-i", list_path, "-c", "copy", output_file_path],
+            capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed: {result.stderr.strip()}")
+    finally:
+        os.remove(list_path)
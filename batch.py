@@ -0,0 +1,412 @@
+import json
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait as wait_for_futures
+
+from api_client import connection_stats
+from chapters import PAGES_PER_CHAPTER, get_chapters
+from main import gen_audio
+from page_index import get_page_index
+from scheduler import RequestScheduler
+from tts_backends import DEFAULT_MAX_WORKERS, get_backend
+
+# Books converted at the same time. Their chunks share the synthesis workers.
+DEFAULT_MAX_JOBS = 4
+
+
+class FairExecutor:
+    """
+    A thread pool shared by several conversions that hands its workers to them in
+    turn, so a long book cannot hold back the others by queueing its chunks first.
+
+    Each conversion submits its work through a lane (see lane). Workers take the next
+    task from each lane that has work waiting in round-robin order.
+
+    Args:
+    - max_workers (int): Number of worker threads.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self._lanes = OrderedDict()  # lane name -> deque of (future, fn, args, kwargs)
+        self._condition = threading.Condition()
+        self._shutdown = False
+        self._threads = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(max_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def lane(self, name):
+        """
+        Returns an Executor whose tasks are queued under name and take turns with the
+        tasks of other lanes.
+        """
+        return _Lane(self, name)
+
+    def _submit(self, name, fn, args, kwargs):
+        future = Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self._lanes.setdefault(name, deque()).append((future, fn, args, kwargs))
+            self._condition.notify()
+        return future
+
+    def _next(self):
+        with self._condition:
+            while not self._lanes and not self._shutdown:
+                self._condition.wait()
+            if not self._lanes:
+                return None
+            name, queue = next(iter(self._lanes.items()))
+            task = queue.popleft()
+            # The lane goes to the back of the line, or leaves it once it is empty.
+            if queue:
+                self._lanes.move_to_end(name)
+            else:
+                del self._lanes[name]
+            return task
+
+    def _work(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def shutdown(self, wait=True):
+        """
+        Stops the workers once every queued task has run.
+        """
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class _Lane(Executor):
+    def __init__(self, executor, name):
+        self._executor = executor
+        self._name = name
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            future = self._executor._submit(self._name, fn, args, kwargs)
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        # Only this lane's tasks stop; the pool belongs to the batch.
+        with self._lock:
+            self._shutdown = True
+            futures = list(self._futures)
+        if cancel_futures:
+            for future in futures:
+                future.cancel()
+        if wait:
+            wait_for_futures(futures)
+
+
+def load_jobs(source):
+    """
+    Reads the conversions to run from a directory or a manifest file.
+
+    A directory converts every PDF in it, all pages, with the default voice. A manifest
+    is a JSON list with one object per conversion:
+
+        {"pdf": "texts/book.pdf", "from": 0, "to": 41, "voice": "nova",
+         "model": "tts-1", "backend": "openai", "speed": 1.0, "format": "m4b",
+         "name": "book-part1"}
+
+    Only "pdf" is required. "from" and "to" are zero-based and inclusive and default
+    to the whole document, and "name" is the output file name without extension.
+    "backend" is the speech engine (see tts_backends), and "voice" and "model" default
+    to the engine's first ones. "format" is the audio format of the output (see
+    gen_audio), "mp3" by default. With "chapters": true the entry is split into one
+    conversion per chapter (see chapter_jobs). Relative PDF paths are resolved against
+    the manifest's folder.
+
+    Returns:
+    - list of dict: One job per conversion, with every field but "to" filled in. A
+      "to" of None stands for the last page and is looked up when the job runs.
+    """
+    if os.path.isdir(source):
+        entries = [{"pdf": os.path.join(source, name)}
+                   for name in sorted(os.listdir(source)) if name.lower().endswith(".pdf")]
+    else:
+        with open(source, "r") as file:
+            entries = json.load(file)
+        base = os.path.dirname(os.path.abspath(source))
+        for entry in entries:
+            entry["pdf"] = os.path.join(base, entry["pdf"])
+
+    jobs = []
+    for entry in entries:
+        stem = os.path.splitext(os.path.basename(entry["pdf"]))[0]
+        pdf_from = entry.get("from", 0)
+        pdf_to = entry.get("to")
+        if "name" in entry:
+            name = entry["name"]
+        elif pdf_to is None:
+            name = stem if pdf_from == 0 else f"{stem}_p{pdf_from + 1}-end"
+        else:
+            name = f"{stem}_p{pdf_from + 1}-{pdf_to + 1}"
+        job = {
+            "pdf": entry["pdf"],
+            "from": pdf_from,
+            "to": pdf_to,
+            "voice": entry.get("voice"),
+            "model": entry.get("model"),
+            "backend": entry.get("backend", "openai"),
+            "speed": entry.get("speed", 1.0),
+            "format": entry.get("format", "mp3"),
+            "name": name,
+        }
+        jobs.extend(chapter_jobs(job) if entry.get("chapters") else [job])
+    return jobs
+
+
+def _file_title(title, max_chars=40):
+    words = re.sub(r"[^\w\s-]+", "", title).split()
+    return "_".join(words)[:max_chars].rstrip("_-")
+
+
+def chapter_jobs(job, pages_per_chapter=PAGES_PER_CHAPTER):
+    """
+    Splits a conversion into one conversion per chapter, following the PDF's outline
+    (see chapters.get_chapters), so every chapter is saved to its own file.
+
+    The chapters are numbered in order, and each is named after the book and its
+    title, such as "book_03_The_Long_Road". Every chapter is a job of its own, so it
+    finishes, fails and resumes independently of the others.
+
+    Args:
+    - job (dict): A conversion as returned by load_jobs.
+    - pages_per_chapter (int): Chapter length for PDFs without an outline.
+
+    Returns:
+    - list of dict: One job per chapter, in order, with the fields of job, the
+      chapter's pages in "from" and "to", its "title", and the original job's name
+      as "book".
+    """
+    pdf_to = job["to"]
+    if pdf_to is None:
+        pdf_to = get_page_index(job["pdf"]).page_count - 1
+    chapters = get_chapters(job["pdf"], job["from"], pdf_to, pages_per_chapter)
+    width = max(2, len(str(len(chapters))))
+    jobs = []
+    for number, chapter in enumerate(chapters, start=1):
+        name = f"{job['name']}_{number:0{width}d}"
+        if _file_title(chapter["title"]):
+            name += f"_{_file_title(chapter['title'])}"
+        jobs.append({**job, "from": chapter["from"], "to": chapter["to"],
+                     "title": chapter["title"], "book": job["name"], "name": name})
+    return jobs
+
+
+def write_playlists(jobs, results, output_path):
+    """
+    Writes an M3U playlist for every book split into chapters, listing the chapters
+    that were converted in order, so a player can go through the book and skip from
+    chapter to chapter.
+
+    Args:
+    - jobs (list of dict): The jobs run, as returned by chapter_jobs or load_jobs.
+      Jobs without a "book" are left out.
+    - results (list of dict): Their results, as returned by run_batch.
+    - output_path (str): The folder the chapters were saved in. The playlists are
+      saved there too, named after their books.
+
+    Returns:
+    - list of str: Paths to the playlists written.
+    """
+    books = OrderedDict()
+    for job, result in zip(jobs, results):
+        if "book" in job:
+            books.setdefault(job["book"], []).append((job, result))
+
+    paths = []
+    for book, chapters in books.items():
+        path = os.path.join(output_path, f"{book}.m3u")
+        with open(path, "w", encoding="utf-8") as playlist:
+            playlist.write(f"#EXTM3U\n#PLAYLIST:{book}\n")
+            for job, result in chapters:
+                if "output" in result:
+                    playlist.write(f"#EXTINF:-1,{job['title']}\n"
+                                   f"{os.path.basename(result['output'])}\n")
+        paths.append(path)
+    return paths
+
+
+def run_batch(jobs, output_path, max_workers=DEFAULT_MAX_WORKERS, max_jobs=DEFAULT_MAX_JOBS,
+              scheduler=None, on_progress=None, cancel_event=None, skip_finished=False):
+    """
+    Converts several PDFs into one audiobook each.
+
+    Up to max_jobs books are converted at the same time. Their speech requests share
+    one pool of max_workers synthesis workers, handed out to the books in turn, and
+    books using the OpenAI API share one RequestScheduler, so the rate limits and
+    backoff apply to the batch as a whole. Books using a local engine are not rate
+    limited.
+    A book that fails does not stop the others; its progress is kept in its job
+    manifest, so running the batch again only redoes what is missing.
+
+    Args:
+    - jobs (list of dict): Conversions as returned by load_jobs.
+    - output_path (str): Folder the MP3 files are written to.
+    - max_workers (int): Speech requests in flight across all books. Default is 4.
+    - max_jobs (int): Books converted at the same time. Default is 4.
+    - scheduler (RequestScheduler): Scheduler to send API requests through. A new one
+      is created when omitted.
+    - on_progress (callable): Receives the progress events of every book (see
+      gen_audio) with the book's name added as "job", plus a "job_failed" event with
+      the "error" for each book that fails and a "job_skipped" event for each book
+      skipped. Called from several threads at once.
+    - cancel_event (threading.Event): Stops every conversion when set, as in
+      gen_audio. Books not started yet fail without doing anything.
+    - skip_finished (bool): Skip books whose output file already exists, so running
+      a batch again only converts the books that did not finish. Default is False.
+
+    Returns:
+    - list of dict: For each job, in order, its "name" and either the "output" path or
+      the "error" that stopped it.
+    """
+    if scheduler is None:
+        scheduler = RequestScheduler(max_concurrency=max_workers)
+    os.makedirs(output_path, exist_ok=True)
+
+    def convert(index, job):
+        def report(event):
+            if on_progress is not None:
+                on_progress({**event, "job": job["name"]})
+
+        if cancel_event is not None and cancel_event.is_set():
+            raise RuntimeError("The conversion was cancelled.")
+        output_file_path = f"{output_path}/{job['name']}.{job['format']}"
+        if skip_finished and os.path.exists(output_file_path):
+            print(f"Skipping {job['name']}, it was already converted")
+            report({"event": "job_skipped", "output": output_file_path})
+            return output_file_path
+        pdf_to = job["to"]
+        if pdf_to is None:
+            pdf_to = get_page_index(job["pdf"]).page_count - 1
+        backend = get_backend(job["backend"])
+        lane = workers.lane(index)
+        try:
+            return gen_audio(job["pdf"], output_path, job["name"], job["from"], pdf_to,
+                             voice=job["voice"], model=job["model"], max_workers=max_workers,
+                             scheduler=scheduler if backend.rate_limited else None,
+                             executor=lane, on_progress=report, cancel_event=cancel_event,
+                             backend=backend, speed=job["speed"], output_format=job["format"])
+        finally:
+            # Nothing of a finished or failed book may still be running on the pool.
+            lane.shutdown(cancel_futures=True)
+
+    results = []
+    with FairExecutor(max_workers) as workers, ThreadPoolExecutor(max_workers=max_jobs) as books:
+        futures = [books.submit(convert, index, job) for index, job in enumerate(jobs)]
+        for job, future in zip(jobs, futures):
+            try:
+                results.append({"name": job["name"], "output": future.result()})
+                print(f"Finished {job['name']}")
+            except Exception as e:
+                results.append({"name": job["name"], "error": str(e)})
+                print(f"Failed to convert {job['name']}: {e}")
+                if on_progress is not None:
+                    on_progress({"event": "job_failed", "job": job["name"], "error": str(e)})
+
+    failed = sum(1 for result in results if "error" in result)
+    stats = scheduler.stats
+    print(f"Batch finished: {len(results) - failed} converted, {failed} failed, "
+          f"{stats['requests']} requests, {stats['retries']} retries")
+    print(connection_stats.summary())
+    return results
+
+
+def convert_chapters(pdf_path, output_path, name, pdf_from=0, pdf_to=None, voice=None,
+                     model=None, backend="openai", speed=1.0, output_format="mp3",
+                     max_workers=None, max_jobs=DEFAULT_MAX_JOBS, index=True,
+                     pages_per_chapter=PAGES_PER_CHAPTER, on_progress=None,
+                     cancel_event=None):
+    """
+    Converts a PDF into one audio file per chapter, with the chapters following its
+    outline (see chapter_jobs).
+
+    The chapters run as a batch (see run_batch): up to max_jobs of them at the same
+    time, sharing the synthesis workers, and each saved as soon as it is finished, so
+    the first chapters can be listened to while the rest are converted. A chapter
+    that fails does not stop the others, and running the conversion again skips the
+    chapters already saved and resumes the rest.
+
+    Args:
+    - pdf_path (str): Path to the input PDF file.
+    - output_path (str): Folder to save the chapters and the playlist in.
+    - name (str): Name of the book. The chapters' file names start with it.
+    - pdf_from (int): First page to convert (zero-based, inclusive).
+    - pdf_to (int): Last page to convert (zero-based, inclusive). Defaults to the
+      last page.
+    - voice, model, backend, speed, output_format: As in gen_audio.
+    - max_workers (int): Speech requests in flight across all chapters. Defaults to
+      the engine's.
+    - max_jobs (int): Chapters converted at the same time. Default is 4.
+    - index (bool): Also write an M3U playlist of the chapters, named after the book.
+      Default is True.
+    - pages_per_chapter (int): Chapter length for PDFs without an outline.
+    - on_progress (callable): Receives the progress events of every chapter, as in
+      run_batch.
+    - cancel_event (threading.Event): Stops the conversion when set.
+
+    Returns:
+    - dict: The result of each chapter as "chapters" (see run_batch), with its
+      "title" added, and the path to the playlist as "index", or None.
+    """
+    job = {"pdf": pdf_path, "from": pdf_from, "to": pdf_to, "voice": voice, "model": model,
+           "backend": backend, "speed": speed, "format": output_format, "name": name}
+    jobs = chapter_jobs(job, pages_per_chapter)
+    os.makedirs(output_path, exist_ok=True)
+    results = run_batch(jobs, output_path,
+                        max_workers=max_workers or get_backend(backend).max_workers,
+                        max_jobs=max_jobs, on_progress=on_progress,
+                        cancel_event=cancel_event, skip_finished=True)
+    playlists = write_playlists(jobs, results, output_path) if index else []
+    return {"chapters": [{**result, "title": job["title"]}
+                         for job, result in zip(jobs, results)],
+            "index": playlists[0] if playlists else None}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python batch.py <folder of PDFs | manifest.json> <output folder> "
+              "[workers] [books at once]")
+        sys.exit(1)
+    jobs = load_jobs(sys.argv[1])
+    results = run_batch(jobs, sys.argv[2],
+                        max_workers=int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_MAX_WORKERS,
+                        max_jobs=int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_MAX_JOBS)
+    write_playlists(jobs, results, sys.argv[2])
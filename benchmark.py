@@ -0,0 +1,442 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from mock_tts_server import fake_mp3
+
+# A result this much worse than the baseline counts as a regression.
+REGRESSION_THRESHOLD = 0.10
+
+_WORDS = ("the of and to in is that for it as was with be by on not he this are or his "
+          "from at which but have an they you were her she there been one all we their "
+          "learning model data network training function value system problem result "
+          "method algorithm input output layer error weight example theory process").split()
+
+
+@contextlib.contextmanager
+def mock_server(latency=0.25, error_rate=0.0, seed=0):
+    """
+    Runs mock_tts_server.py in its own process and points the OpenAI client at it.
+
+    The server runs in a separate process so its CPU time and memory are not counted
+    as the pipeline's. Start it before the first request: the shared API client keeps
+    the base URL it was created with.
+
+    Args:
+    - latency (float): Seconds the server waits before answering each request.
+    - error_rate (float): Fraction of requests answered with a 429, 500 or 503.
+    - seed (int): Seeds the choice of failing requests.
+    """
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_tts_server.py")
+    process = subprocess.Popen(
+        [sys.executable, server_path, str(port), str(latency), str(error_rate), str(seed)],
+        stdout=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError("The mock TTS server did not start.")
+                time.sleep(0.05)
+        os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+        os.environ.setdefault("OPENAI_API_KEY", "mock")
+        yield
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def _chunk_texts(count, chars=4000):
+    # Each chunk starts differently so none of them are deduplicated.
+    return [(f"chunk {i} " + "lorem ipsum " * (chars // 12 + 1))[:chars] for i in range(count)]
+
+
+def bench_synthesis(chunks=16, workers=(1, 4, 8)):
+    """
+    Times synthesize_text, run on chunks in parallel, against the mock TTS server for
+    several worker counts. Run it inside mock_server.
+
+    Args:
+    - chunks (int): Number of text chunks to synthesize.
+    - workers (iterable of int): Concurrency limits to compare.
+
+    Returns:
+    - dict: The "seconds" and "chars_per_second" of each worker count.
+    """
+    from main import synthesize_text
+    from scheduler import RequestScheduler
+    from tts_backends import get_backend
+
+    backend = get_backend("openai")
+    texts = _chunk_texts(chunks)
+    chars = sum(len(text) for text in texts)
+    results = {}
+    for max_workers in workers:
+        with tempfile.TemporaryDirectory() as directory:
+            # A short backoff, so injected errors cost retries rather than whole seconds.
+            scheduler = RequestScheduler(max_concurrency=max_workers, base_delay=0.1)
+
+            def synthesize(index):
+                return synthesize_text(backend, scheduler, texts[index],
+                                       os.path.join(directory, f"bench_part{index + 1}.mp3"))
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(synthesize, range(len(texts))))
+            seconds = time.perf_counter() - start
+            results[f"workers={max_workers}"] = {"seconds": seconds,
+                                                 "chars_per_second": chars / seconds}
+
+    baseline = results.get("workers=1")
+    for case, result in results.items():
+        speedup = f" ({baseline['seconds'] / result['seconds']:.1f}x)" if baseline else ""
+        print(f"synthesis {case}: {result['seconds']:.2f}s, "
+              f"{result['chars_per_second']:.0f} chars/s{speedup}")
+    return results
+
+
+def _prose(rng, words):
+    sentences = []
+    count = 0
+    while count < words:
+        length = rng.randint(6, 24)
+        sentence = " ".join(rng.choice(_WORDS) for _ in range(length))
+        sentences.append(sentence[0].upper() + sentence[1:] + ".")
+        count += length
+    return " ".join(sentences)
+
+
+def _make_pdf(path, pages, words_per_page=450, seed=0):
+    """
+    Writes a synthetic PDF of generated sentences, with a running header and a page
+    number on every page like a real book. The same seed gives the same text, and
+    different seeds give text that shares no chunks, so it is never found in the audio
+    cache or deduplicated.
+    """
+    import fitz
+
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for page_number in range(pages):
+        page = doc.new_page()
+        page.insert_text((50, 40), "A Synthetic Benchmark Book", fontsize=8)
+        page.insert_textbox(fitz.Rect(50, 55, page.rect.width - 50, page.rect.height - 60),
+                            _prose(rng, words_per_page), fontsize=10)
+        page.insert_text((page.rect.width / 2, page.rect.height - 30), str(page_number + 1),
+                         fontsize=8)
+    doc.save(path)
+    doc.close()
+
+
+def bench_extraction(pages=400, workers=(1, 2, 4, 8)):
+    """
+    Times extracting a synthetic PDF into an empty page index with different numbers
+    of worker processes.
+
+    Args:
+    - pages (int): Pages in the synthetic PDF.
+    - workers (iterable of int): Worker process counts to compare.
+
+    Returns:
+    - dict: The "seconds", "pages_per_second" and "chars_per_second" of each worker
+      count.
+    """
+    from page_index import PageIndex
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        pdf_path = os.path.join(directory, "bench.pdf")
+        _make_pdf(pdf_path, pages)
+        for count in workers:
+            index = PageIndex(pdf_path, os.path.join(directory, f"index_{count}.sqlite"))
+            chars = 0
+            start = time.perf_counter()
+            for record in index.iter_pages(0, pages - 1, workers=count):
+                chars += record["chars"]
+            seconds = time.perf_counter() - start
+            results[f"workers={count}"] = {"seconds": seconds,
+                                           "pages_per_second": pages / seconds,
+                                           "chars_per_second": chars / seconds}
+
+    baseline = results.get("workers=1")
+    for case, result in results.items():
+        speedup = f" ({baseline['seconds'] / result['seconds']:.1f}x)" if baseline else ""
+        print(f"extraction {case}: {result['seconds']:.2f}s, "
+              f"{result['pages_per_second']:.0f} pages/s{speedup}")
+    return results
+
+
+def iter_text_chunks(texts, max_chars=4000):
+    """
+    Groups the words of a stream of texts into chunks of up to max_chars characters
+    without splitting words, yielding each chunk as soon as it is full. This is how
+    the converter chunked text before chunking.iter_sentence_chunks, kept here for
+    bench_chunking to compare against.
+
+    Args:
+    - texts (iterable of str): The texts to split, such as the texts of pages.
+    - max_chars (int): Maximum number of characters for each chunk. Default is 4000.
+
+    Yields:
+    - str: One chunk of text.
+    """
+    chunk = []
+    chunk_size = 0
+    for text in texts:
+        for word in text.split():
+            word_size = len(word) + 1
+
+            if chunk_size + word_size > max_chars:
+                yield ' '.join(chunk)
+                chunk = []
+                chunk_size = 0
+
+            chunk.append(word)
+            chunk_size += word_size
+
+    if chunk:
+        yield ' '.join(chunk)
+
+
+def bench_chunking(pdf_paths=("texts/AiTextch1-1.pdf", "texts/AiTextch7-1.pdf"), copies=50):
+    """
+    Compares the whitespace splitter (iter_text_chunks) with the sentence-aware
+    chunker (iter_sentence_chunks) on the pages of real PDFs repeated copies times.
+
+    Reports throughput, the number of chunks (API requests), how full the chunks are
+    and how many chunks end in the middle of a sentence.
+
+    Returns:
+    - dict: The "seconds", "chars_per_second", "chunks" and "mid_sentence_cuts" of
+      each chunker.
+    """
+    import re
+
+    from chunking import MAX_INPUT_CHARS, iter_sentence_chunks
+    from page_index import extract_page
+
+    import fitz
+
+    pages = []
+    for pdf_path in pdf_paths:
+        with fitz.open(pdf_path) as doc:
+            pages.extend(extract_page(page)["text"] for page in doc)
+    texts = pages * copies
+    chars = sum(len(text) for text in texts)
+    sentence_end = re.compile(r"[.!?:][\"'”’)\]]*$")
+
+    results = {}
+    for name, chunker, limit in (("whitespace", iter_text_chunks, 4000),
+                                 ("sentence", iter_sentence_chunks, MAX_INPUT_CHARS)):
+        start = time.perf_counter()
+        chunks = list(chunker(texts, limit))
+        seconds = time.perf_counter() - start
+        cuts = sum(1 for chunk in chunks[:-1] if not sentence_end.search(chunk))
+        fill = sum(len(chunk) for chunk in chunks) / len(chunks) / MAX_INPUT_CHARS
+        results[name] = {"seconds": seconds, "chars_per_second": chars / seconds,
+                         "chunks": len(chunks), "mid_sentence_cuts": cuts}
+        print(f"chunking {name}: {chars / 1e6 / seconds:.1f} MB/s, {len(chunks)} requests, "
+              f"{fill:.0%} of the API limit used, {cuts} chunks end mid-sentence")
+    return results
+
+
+def bench_stitch(chunks=50, chars=4000, modes=("frames", "ffmpeg", "reencode")):
+    """
+    Times stitch_mp3_files in each mode, then runs it again to measure its peak Python
+    memory use (tracing allocations slows it down, so the two are measured separately).
+
+    Modes that need ffmpeg are skipped when it is not installed.
+
+    Args:
+    - chunks (int): Number of MP3 files to stitch.
+    - chars (int): Characters of text each file stands for, which sets its length.
+    - modes (iterable of str): Stitch modes to compare.
+
+    Returns:
+    - dict: The "seconds" and "peak_bytes" of each mode that ran.
+    """
+    from main import stitch_mp3_files
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(chunks):
+            path = os.path.join(directory, f"bench_part{i + 1}.mp3")
+            with open(path, "wb") as file:
+                file.write(fake_mp3("x" * chars))
+            paths.append(path)
+
+        for mode in modes:
+            if mode != "frames" and shutil.which("ffmpeg") is None:
+                print(f"stitch mode={mode}: skipped, ffmpeg is not installed")
+                continue
+            output_path = os.path.join(directory, f"stitched_{mode}.mp3")
+            start = time.perf_counter()
+            stitch_mp3_files(paths, output_path, mode=mode)
+            seconds = time.perf_counter() - start
+
+            tracemalloc.start()
+            stitch_mp3_files(paths, output_path, mode=mode)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[f"mode={mode}"] = {"seconds": seconds, "peak_bytes": peak}
+            print(f"stitch mode={mode}: {seconds:.2f}s, peak memory {peak / 1e6:.1f} MB")
+    return results
+
+
+def bench_pipeline(sizes=(20, 100), max_workers=4):
+    """
+    Runs the whole of gen_audio on synthetic PDFs of different sizes, from extraction
+    to the finished MP3, against the mock TTS server. Run it inside mock_server, with
+    an empty page index and audio cache.
+
+    Each size is converted twice, from PDFs with different text so neither run finds
+    the other's pages or audio: once to time it, and once with allocations traced to
+    measure its peak memory.
+
+    Args:
+    - sizes (iterable of int): Page counts of the PDFs to convert.
+    - max_workers (int): Concurrent speech requests.
+
+    Returns:
+    - dict: The "seconds", "pages_per_second", "chars_per_second" and "peak_bytes" of
+      each size.
+    """
+    from main import gen_audio
+    from metrics import Metrics
+    from scheduler import RequestScheduler
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size_index, pages in enumerate(sizes):
+            runs = []
+            for traced in (False, True):
+                name = f"book_{pages}_{'traced' if traced else 'timed'}"
+                pdf_path = os.path.join(directory, f"{name}.pdf")
+                _make_pdf(pdf_path, pages, seed=2 * size_index + traced)
+                metrics = Metrics()
+                scheduler = RequestScheduler(max_concurrency=max_workers, base_delay=0.1)
+                if traced:
+                    tracemalloc.start()
+                start = time.perf_counter()
+                # The conversion's own log would bury the results.
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    gen_audio(pdf_path, directory, name, 0, pages - 1,
+                              max_workers=max_workers, scheduler=scheduler, metrics=metrics)
+                seconds = time.perf_counter() - start
+                peak = None
+                if traced:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                runs.append((seconds, peak, metrics.report()))
+
+            (seconds, _, report), (_, peak, _) = runs
+            chars = report["stages"]["chunk"]["chars"]
+            results[f"pages={pages}"] = {"seconds": seconds, "pages_per_second": pages / seconds,
+                                         "chars_per_second": chars / seconds, "peak_bytes": peak}
+            print(f"pipeline pages={pages}: {seconds:.2f}s, {pages / seconds:.1f} pages/s, "
+                  f"{chars / seconds:.0f} chars/s, peak memory {peak / 1e6:.1f} MB")
+    return results
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Compares benchmark results with earlier ones saved with --json.
+
+    A measurement has regressed when a throughput ("*_per_second") dropped, or
+    "seconds" or "peak_bytes" grew, by more than threshold. Cases missing from the
+    baseline are skipped.
+
+    Returns:
+    - list of str: A description of each regression.
+    """
+    regressions = []
+    for benchmark, cases in results.items():
+        for case, values in cases.items():
+            before = baseline.get(benchmark, {}).get(case, {})
+            for metric, value in values.items():
+                old = before.get(metric)
+                if not old or value is None:
+                    continue
+                if metric.endswith("_per_second"):
+                    change = (old - value) / old
+                elif metric in ("seconds", "peak_bytes"):
+                    change = (value - old) / old
+                else:
+                    continue
+                if change > threshold:
+                    regressions.append(f"{benchmark} {case} {metric}: {old:.4g} -> {value:.4g} "
+                                       f"({change:.0%} worse)")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks each stage of the PDF to audio pipeline, and the whole of "
+                    "it, against a local mock TTS server.")
+    parser.add_argument("benchmark", nargs="?", default="synthesis",
+                        choices=("synthesis", "stitch", "chunking", "extraction", "pipeline",
+                                 "all"))
+    parser.add_argument("count", nargs="?", type=int,
+                        help="Chunks (synthesis, stitch), copies (chunking) or pages "
+                             "(extraction, pipeline).")
+    parser.add_argument("--latency", type=float, default=0.25,
+                        help="Seconds the mock server takes per request.")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of requests the mock server fails.")
+    parser.add_argument("--json", metavar="FILE", help="Save the results to FILE.")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="Compare with results saved with --json and exit with status 1 "
+                             "if any got more than 10%% worse.")
+    args = parser.parse_args()
+
+    # Start from an empty page index and audio cache, so every run does the same work.
+    # They are read when main is first imported.
+    workspace = tempfile.mkdtemp(prefix="pdf_tts_benchmark_")
+    os.environ["PAGE_INDEX_PATH"] = os.path.join(workspace, "page_index.sqlite")
+    os.environ["TTS_CACHE_DIR"] = os.path.join(workspace, "audio")
+
+    benchmarks = {
+        "synthesis": lambda: bench_synthesis(chunks=args.count or 16),
+        "extraction": lambda: bench_extraction(pages=args.count or 400),
+        "chunking": lambda: bench_chunking(copies=args.count or 50),
+        "stitch": lambda: bench_stitch(chunks=args.count or 50),
+        "pipeline": lambda: bench_pipeline(sizes=(args.count,) if args.count else (20, 100)),
+    }
+    selected = list(benchmarks) if args.benchmark == "all" else [args.benchmark]
+    results = {}
+    try:
+        with mock_server(args.latency, args.error_rate):
+            for name in selected:
+                results[name] = benchmarks[name]()
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Results saved to {args.json}")
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            regressions = compare(results, json.load(file))
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+DEFAULT_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "cache/audio")
+DEFAULT_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_MB", "1024")) * 1024 * 1024
+
+
+def normalize_text(text):
+    """
+    Collapses all runs of whitespace so that chunks differing only in spacing or line
+    breaks share a cache entry.
+    """
+    return " ".join(text.split())
+
+
+def cache_key(text, voice, model, speed=1.0, audio_format="mp3"):
+    """
+    Returns the content hash that identifies a chunk's audio.
+
+    Args:
+    - text (str): The chunk text.
+    - voice (str): The voice used to speak it.
+    - model (str): The TTS model used to synthesize it. Every speech engine has its
+      own model names, so this also tells the engines apart.
+    - speed (float): How fast it was spoken.
+    - audio_format (str): The format it was synthesized in.
+
+    Returns:
+    - str: A hex SHA-256 digest.
+    """
+    parts = [model, voice, normalize_text(text)]
+    # MP3 audio at normal speed keeps the keys it had before either was configurable.
+    if speed != 1.0:
+        parts.append(repr(float(speed)))
+    if audio_format != "mp3":
+        parts.append(audio_format)
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class SynthesisCache:
+    """
+    An on-disk cache of synthesized chunk audio keyed on (text, voice, model, speed, format).
+
+    Entries are named after their key and have their audio format as extension.
+    When the cache grows past max_bytes, the least recently used entries are removed.
+    Every lookup updates the entry's modification time, which is what "recently used"
+    is measured by. The cache's size is measured once and then kept up to date as
+    entries are added, and measured again whenever it seems to be over the limit, in
+    case other conversions sharing the directory have changed it.
+
+    Args:
+    - directory (str): Where cached audio is stored. Defaults to TTS_CACHE_DIR or cache/audio.
+    - max_bytes (int): Size limit of the cache. Defaults to TTS_CACHE_MAX_MB or 1 GB.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._total_bytes = None  # measured on the first put
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, audio_format="mp3"):
+        return os.path.join(self.directory, key[:2], f"{key}.{audio_format}")
+
+    def get(self, text, voice, model, output_path, speed=1.0, audio_format="mp3"):
+        """
+        Copies the cached audio for a chunk to output_path if there is any.
+
+        Returns:
+        - bool: True on a cache hit, False on a miss.
+        """
+        path = self._path(cache_key(text, voice, model, speed, audio_format), audio_format)
+        try:
+            shutil.copyfile(path, output_path)
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.stats["misses"] += 1
+            return False
+        with self._lock:
+            self.stats["hits"] += 1
+        return True
+
+    def put(self, text, voice, model, audio_path, speed=1.0, audio_format="mp3"):
+        """
+        Stores a copy of a chunk's synthesized audio, evicting old entries if needed.
+        """
+        path = self._path(cache_key(text, voice, model, speed, audio_format), audio_format)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial entry.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(audio_path, temp_path)
+        size = os.path.getsize(temp_path)
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(temp_path, path)
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += size - replaced
+                if self._total_bytes <= self.max_bytes:
+                    return
+        self.evict()
+
+    def evict(self):
+        """
+        Measures the cache and removes least recently used entries until it fits in
+        max_bytes.
+        """
+        with self._lock:
+            entries = []
+            total = 0
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if name.endswith(".tmp"):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        # Removed by another process sharing the cache.
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+                    total += stat.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                total -= size
+                self.stats["evictions"] += 1
+            self._total_bytes = total
+
+    def summary(self):
+        hits, misses = self.stats["hits"], self.stats["misses"]
+        return f"Cache: {hits} hits, {misses} misses, {self.stats['evictions']} evictions"
@@ -0,0 +1,62 @@
+import os
+
+import fitz
+
+# Pages in each chapter of a PDF without an outline.
+PAGES_PER_CHAPTER = int(os.getenv("PAGES_PER_CHAPTER", "10"))
+
+
+def _page_title(first, last):
+    return f"Page {first + 1}" if first == last else f"Pages {first + 1}-{last + 1}"
+
+
+def get_chapters(pdf_path, pdf_from, pdf_to, pages_per_chapter=PAGES_PER_CHAPTER, level=1):
+    """
+    Splits a page range into chapters, following the PDF's outline (its table of
+    contents) when it has one, or in runs of pages_per_chapter pages when it does not.
+
+    A chapter starts at the page of every outline entry of the given level, and the
+    first entry on a page names it. When the range starts part way through a chapter,
+    its first chapter is named after the one it is part of, and pages before the first
+    entry are named by their page numbers.
+
+    Args:
+    - pdf_path (str): Path to the PDF file.
+    - pdf_from (int): First page of the range (zero-based, inclusive).
+    - pdf_to (int): Last page of the range (zero-based, inclusive). Clamped to the
+      last page of the document.
+    - pages_per_chapter (int): Chapter length for documents without an outline.
+    - level (int): The outline level chapters start at, 1 being the top.
+
+    Returns:
+    - list of dict: The "title", first page ("from") and last page ("to") of each
+      chapter, zero-based and inclusive, in order. Together they cover the range.
+    """
+    with fitz.open(pdf_path) as doc:
+        toc = doc.get_toc()
+        pdf_to = min(pdf_to, doc.page_count - 1)
+
+    starts = {}
+    for entry_level, title, page in toc:
+        # Entries that do not point at a page have a page number below 1.
+        if entry_level == level and page >= 1:
+            starts.setdefault(page - 1, " ".join(title.split()) or _page_title(page - 1, page - 1))
+
+    if not starts:
+        return [{"title": _page_title(first, min(first + pages_per_chapter - 1, pdf_to)),
+                 "from": first, "to": min(first + pages_per_chapter - 1, pdf_to)}
+                for first in range(pdf_from, pdf_to + 1, pages_per_chapter)]
+
+    before = [page for page in starts if page <= pdf_from]
+    boundaries = sorted({pdf_from} | {page for page in starts if pdf_from < page <= pdf_to})
+    chapters = []
+    for position, first in enumerate(boundaries):
+        last = boundaries[position + 1] - 1 if position + 1 < len(boundaries) else pdf_to
+        if first in starts:
+            title = starts[first]
+        elif before:
+            title = starts[max(before)]
+        else:
+            title = _page_title(first, last)
+        chapters.append({"title": title, "from": first, "to": last})
+    return chapters
@@ -0,0 +1,119 @@
+import re
+
+# Longest input the speech API accepts in one request.
+MAX_INPUT_CHARS = 4096
+
+# A chunk this full is ended at a paragraph break rather than in the next paragraph.
+PARAGRAPH_FILL = 0.98
+
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+# A sentence ends with . ! or ?, optionally followed by closing quotes or brackets,
+# and the next one starts with a capital letter, digit or opening quote or bracket.
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])([\"'”’)\]]*)\s+(?=[\"'“‘(\[]*[A-Z0-9])")
+_CLAUSE_BREAK = re.compile(r"(?<=[;:,])\s+")
+_PARAGRAPH_END = re.compile(r"[.!?:][\"'”’)\]]*$")
+
+
+def iter_paragraphs(texts, max_chars=MAX_INPUT_CHARS):
+    """
+    Yields the paragraphs of a stream of page texts with their whitespace collapsed.
+
+    Paragraphs are separated by blank lines. A paragraph that stops without finishing
+    its sentence, such as one cut by a column or page break, is joined with the next,
+    unless it is already longer than max_chars.
+    """
+    carry = ""
+    for text in texts:
+        for paragraph in _PARAGRAPH_BREAK.split(text):
+            paragraph = " ".join(paragraph.split())
+            if not paragraph:
+                continue
+            if carry:
+                paragraph = f"{carry} {paragraph}"
+            if _PARAGRAPH_END.search(paragraph) or len(paragraph) > max_chars:
+                carry = ""
+                yield paragraph
+            else:
+                carry = paragraph
+    if carry:
+        yield carry
+
+
+def split_sentences(paragraph):
+    """
+    Splits a paragraph into sentences, keeping any closing quotes with their sentence.
+    """
+    parts = _SENTENCE_BREAK.split(paragraph)
+    # re.split returns [sentence, closing, sentence, closing, ..., sentence].
+    sentences = [parts[i] + (parts[i + 1] if i + 1 < len(parts) else "")
+                 for i in range(0, len(parts), 2)]
+    return [sentence for sentence in sentences if sentence]
+
+
+def _split_long(sentence, max_chars):
+    """
+    Splits a sentence longer than max_chars at clause breaks, and at word breaks where
+    a clause is still too long.
+    """
+    pieces = []
+    current = ""
+    for clause in _CLAUSE_BREAK.split(sentence):
+        for word in ([clause] if len(clause) <= max_chars else clause.split()):
+            candidate = f"{current} {word}" if current else word
+            if len(candidate) <= max_chars:
+                current = candidate
+                continue
+            if current:
+                pieces.append(current)
+            # A single word longer than a whole chunk is cut where it must be.
+            while len(word) > max_chars:
+                pieces.append(word[:max_chars])
+                word = word[max_chars:]
+            current = word
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def iter_sentence_chunks(texts, max_chars=MAX_INPUT_CHARS):
+    """
+    Packs a stream of texts into chunks of up to max_chars characters, breaking only
+    between sentences where possible.
+
+    Sentences are added to a chunk until the next one does not fit. Paragraphs inside
+    a chunk are separated by a line break, and a chunk that is already nearly full is
+    ended at a paragraph break instead of starting a paragraph it cannot finish.
+    Sentences longer than a whole chunk are split at clause, then word, boundaries.
+    Chunks are yielded as soon as they are full.
+
+    Args:
+    - texts (iterable of str): The texts to split, such as page texts.
+    - max_chars (int): Maximum number of characters for each chunk. Default is the
+      4096 character limit of the speech API.
+
+    Yields:
+    - str: One chunk of text.
+    """
+    chunk = ""
+    for paragraph in iter_paragraphs(texts, max_chars):
+        if chunk:
+            fits = len(chunk) + 1 + len(paragraph) <= max_chars
+            if not fits and len(chunk) >= PARAGRAPH_FILL * max_chars:
+                yield chunk
+                chunk = ""
+
+        separator = "\n"
+        for sentence in split_sentences(paragraph):
+            for piece in (_split_long(sentence, max_chars) if len(sentence) > max_chars
+                          else [sentence]):
+                if not chunk:
+                    chunk = piece
+                elif len(chunk) + 1 + len(piece) <= max_chars:
+                    chunk = f"{chunk}{separator}{piece}"
+                else:
+                    yield chunk
+                    chunk = piece
+                separator = " "
+
+    if chunk:
+        yield chunk
@@ -0,0 +1,214 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+
+from api_client import connection_stats
+from audio import OUTPUT_FORMATS
+from batch import DEFAULT_MAX_JOBS, convert_chapters, load_jobs, run_batch, write_playlists
+from main import PREVIEW_SECONDS, gen_audio, get_estimate, preview_audio
+from metrics import JsonLinesSink, Metrics
+from page_index import get_page_index
+from tts_backends import BACKENDS, DEFAULT_MAX_WORKERS
+
+
+class JsonProgress:
+    """
+    Writes progress events as JSON, one object per line, for servers, containers and
+    monitoring to read.
+
+    Every event gets the seconds "elapsed" since the run started. "chunk" events also
+    get the throughput of their job so far, in "chars_per_second" and
+    "chunks_per_second". Safe to call from several threads.
+
+    Args:
+    - stream (file): Where the events are written. Defaults to stdout.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self.start = time.monotonic()
+        self._totals = {}  # job -> [chars, chunks] written in this run
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            elapsed = time.monotonic() - self.start
+            event = {**event, "elapsed": round(elapsed, 3)}
+            if event["event"] == "chunk":
+                totals = self._totals.setdefault(event.get("job"), [0, 0])
+                totals[0] += event["chars"]
+                totals[1] += 1
+                if elapsed > 0:
+                    event["chars_per_second"] = round(totals[0] / elapsed, 1)
+                    event["chunks_per_second"] = round(totals[1] / elapsed, 3)
+            self.stream.write(json.dumps(event) + "\n")
+            self.stream.flush()
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        description="Convert PDF files to MP3 audiobooks without the GUI. Progress is "
+                    "written to stdout as JSON lines and log messages to stderr.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="Convert a page range of one PDF.")
+    generate.add_argument("pdf", help="The PDF file to convert.")
+    generate.add_argument("output_folder", help="Folder to save the MP3 file in.")
+    generate.add_argument("--name", help="Output file name without extension. "
+                                         "Defaults to the PDF's name.")
+    generate.add_argument("--workers", type=int,
+                          help="Concurrent speech requests. Default is 4 for the OpenAI API "
+                               "and one per core for local engines.")
+    generate.add_argument("--no-clean", action="store_true",
+                          help="Keep headers, footers and page numbers in the text.")
+    generate.add_argument("--preview-dir",
+                          help="Also save each chunk's audio here as soon as it is written, "
+                               "to play it before the book is finished.")
+    generate.add_argument("--metrics", metavar="FILE",
+                          help="Append stage timings and request latencies to FILE as JSON lines.")
+    generate.add_argument("--profile", choices=("cprofile", "tracemalloc"),
+                          help="Profile the conversion; the results go to stderr.")
+
+    chapters = commands.add_parser("chapters", help="Convert a PDF into one file per chapter, "
+                                                    "following its table of contents.")
+    chapters.add_argument("pdf", help="The PDF file to convert.")
+    chapters.add_argument("output_folder", help="Folder to save the chapters in.")
+    chapters.add_argument("--name", help="Name of the book; the chapters' file names start "
+                                         "with it. Defaults to the PDF's name.")
+    chapters.add_argument("--workers", type=int,
+                          help="Concurrent speech requests across all chapters. Default is 4 "
+                               "for the OpenAI API and one per core for local engines.")
+    chapters.add_argument("--books", type=int, default=DEFAULT_MAX_JOBS,
+                          help="Chapters converted at the same time.")
+    chapters.add_argument("--no-index", action="store_true",
+                          help="Do not write an M3U playlist of the chapters.")
+
+    preview = commands.add_parser("preview", help="Synthesize only the start of a conversion.")
+    preview.add_argument("pdf", help="The PDF file to preview.")
+    preview.add_argument("output", help="Where to save the preview MP3 file.")
+    preview.add_argument("--seconds", type=float, default=PREVIEW_SECONDS,
+                         help="Approximate length of the preview.")
+
+    estimate = commands.add_parser("estimate", help="Estimate the price and length of a "
+                                                    "conversion.")
+    estimate.add_argument("pdf", help="The PDF file to estimate.")
+
+    for command in (generate, chapters):
+        command.add_argument("--format", dest="output_format", choices=list(OUTPUT_FORMATS),
+                             default="mp3",
+                             help="Audio format. m4b is an audiobook with chapter markers; "
+                                  "every format but mp3, aac and wav needs ffmpeg.")
+    for command in (generate, chapters, preview, estimate):
+        command.add_argument("--from", dest="pdf_from", type=int, default=0,
+                             help="First page (zero-based, inclusive). Default is 0.")
+        command.add_argument("--to", dest="pdf_to", type=int,
+                             help="Last page (zero-based, inclusive). Default is the last.")
+        command.add_argument("--backend", choices=list(BACKENDS), default="openai",
+                             help="Speech engine. espeak runs locally, for free.")
+        command.add_argument("--model", help="Defaults to the engine's first model.")
+        command.add_argument("--speed", type=float, default=1.0,
+                             help="How fast to speak, 1.0 being normal speed.")
+    for command in (generate, chapters, preview):
+        command.add_argument("--voice", help="Defaults to the engine's first voice.")
+
+    batch = commands.add_parser("batch", help="Convert a folder of PDFs or a JSON manifest.")
+    batch.add_argument("source", help="Folder of PDFs or manifest file (see batch.load_jobs).")
+    batch.add_argument("output_folder", help="Folder to save the MP3 files in.")
+    batch.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS,
+                       help="Concurrent speech requests across all books.")
+    batch.add_argument("--books", type=int, default=DEFAULT_MAX_JOBS,
+                       help="Books converted at the same time.")
+    return parser
+
+
+def _page_range(parser, args):
+    page_count = get_page_index(args.pdf).page_count
+    pdf_to = page_count - 1 if args.pdf_to is None else args.pdf_to
+    if args.pdf_from < 0 or pdf_to < 0:
+        parser.error("pages are numbered from 0")
+    if max(args.pdf_from, pdf_to) >= page_count:
+        parser.error(f"{args.pdf} has {page_count} pages, numbered from 0 to {page_count - 1}")
+    if args.pdf_from > pdf_to:
+        parser.error(f"--from {args.pdf_from} is after --to {pdf_to}")
+    return args.pdf_from, pdf_to
+
+
+def main(argv=None):
+    """
+    Runs the command line interface. See python cli.py --help.
+
+    Returns:
+    - int: The exit status, 0 on success.
+    """
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if args.command != "batch" and not os.path.isfile(args.pdf):
+        parser.error(f"{args.pdf} does not exist")
+    progress = JsonProgress()
+    # Log messages would break up the JSON lines, so they go to stderr.
+    with redirect_stdout(sys.stderr):
+        try:
+            if args.command != "batch":
+                pdf_from, pdf_to = _page_range(parser, args)
+            if args.command == "generate":
+                os.makedirs(args.output_folder, exist_ok=True)
+                if args.preview_dir:
+                    os.makedirs(args.preview_dir, exist_ok=True)
+                metrics = Metrics([JsonLinesSink(args.metrics)] if args.metrics else [])
+                try:
+                    output = gen_audio(args.pdf, args.output_folder,
+                                       args.name or Path(args.pdf).stem, pdf_from, pdf_to,
+                                       voice=args.voice, model=args.model,
+                                       max_workers=args.workers, clean_text=not args.no_clean,
+                                       on_progress=progress, preview_dir=args.preview_dir,
+                                       metrics=metrics, profile=args.profile,
+                                       backend=args.backend, speed=args.speed,
+                                       output_format=args.output_format)
+                finally:
+                    metrics.close()
+                progress({"event": "result", "output": output})
+            elif args.command == "chapters":
+                result = convert_chapters(args.pdf, args.output_folder,
+                                          args.name or Path(args.pdf).stem, pdf_from, pdf_to,
+                                          voice=args.voice, model=args.model,
+                                          backend=args.backend, speed=args.speed,
+                                          output_format=args.output_format,
+                                          max_workers=args.workers, max_jobs=args.books,
+                                          index=not args.no_index, on_progress=progress)
+                progress({"event": "result", **result})
+                if any("error" in chapter for chapter in result["chapters"]):
+                    return 1
+            elif args.command == "preview":
+                output = preview_audio(args.pdf, pdf_from, pdf_to, args.output,
+                                       seconds=args.seconds, voice=args.voice, model=args.model,
+                                       backend=args.backend, speed=args.speed)
+                progress({"event": "result", "output": output})
+            elif args.command == "estimate":
+                progress({"event": "result", **get_estimate(args.pdf, pdf_from, pdf_to,
+                                                            backend=args.backend,
+                                                            model=args.model,
+                                                            speed=args.speed)})
+            else:
+                jobs = load_jobs(args.source)
+                results = run_batch(jobs, args.output_folder,
+                                    max_workers=args.workers, max_jobs=args.books,
+                                    on_progress=progress)
+                write_playlists(jobs, results, args.output_folder)
+                progress({"event": "result", "jobs": results})
+                if any("error" in result for result in results):
+                    return 1
+        except Exception as e:
+            progress({"event": "error", "error": str(e)})
+            return 1
+        finally:
+            progress({"event": "connections", **connection_stats.as_dict()})
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+import math
+import threading
+from collections import deque
+
+from chunking import MAX_INPUT_CHARS, iter_sentence_chunks
+from normalize import TextCleaner
+from page_index import get_page_index
+
+# Price of the tts-1 model in cents per million characters.
+CENTS_PER_MILLION_CHARS = 1500
+# Typical speaking rate of the OpenAI voices at normal speed.
+WORDS_PER_MINUTE = 150
+# The same rate in characters, at about six characters a word including spaces.
+CHARS_PER_SECOND = WORDS_PER_MINUTE * 6 / 60
+
+# Counts of the pages estimated so far, by (doc_hash, max_chars, clean_text), then page.
+_page_counts = {}
+_page_counts_lock = threading.Lock()
+
+
+def _spoken_length(text):
+    return len(" ".join(text.split()))
+
+
+def _next_chunk(counts, page):
+    """
+    Returns the first chunk completed after page, or None if the pages after it have
+    not been counted.
+    """
+    page += 1
+    while page in counts:
+        if counts[page]["chunks"]:
+            return counts[page]["chunks"][0]
+        page += 1
+    return None
+
+
+class PriceEstimator:
+    """
+    Estimates the cost and length of converting page ranges of one PDF file.
+
+    Page text comes from the document's persistent page index and is cleaned and
+    chunked the same way as by gen_audio, so the characters and requests counted are
+    the ones that would be billed. Only a few counts are kept for each page: its
+    words and characters, the characters cleanup removed, and a hash, the length and
+    the first page of each chunk completed on it. A range whose pages have all been
+    counted before is estimated from these counts without reading any text;
+    otherwise the whole range is counted again. A chunk cut by either end of such a
+    range is estimated from the characters of the range's pages it does not cover.
+
+    Args:
+    - pdf_path (str): Path to the PDF file.
+    """
+
+    def __init__(self, pdf_path):
+        self.pdf_path = pdf_path
+
+    def estimate(self, from_page, to_page, max_chars=MAX_INPUT_CHARS, clean_text=True,
+                 speed=1.0):
+        """
+        Estimates the conversion of a page range.
+
+        Args:
+        - from_page (int): First page (zero-based, inclusive).
+        - to_page (int): Last page (zero-based, inclusive).
+        - max_chars (int): Chunk size used by the conversion. Default is 4096.
+        - clean_text (bool): Whether the conversion removes headers, footers and other
+          boilerplate first. Default is True.
+        - speed (float): How fast the conversion speaks, 1.0 being normal speed. The
+          length assumes WORDS_PER_MINUTE at normal speed.
+
+        Returns:
+        - dict: "characters" billed, number of "chunks" (API requests), "price_cents"
+          and "duration_seconds" of the resulting audio, and "removed_characters" that
+          text cleanup and "repeated_characters" that reusing the audio of repeated
+          chunks keep from being billed.
+        """
+        index = get_page_index(self.pdf_path)
+        to_page = min(to_page, index.page_count - 1)
+        with _page_counts_lock:
+            counts = _page_counts.setdefault((index.doc_hash, max_chars, clean_text), {})
+            counted = all(page in counts for page in range(from_page, to_page + 1))
+        if not counted:
+            self._count(index, from_page, to_page, max_chars, clean_text, counts)
+
+        words = 0
+        removed = 0
+        page_chars = 0
+        characters = 0
+        chunks = 0
+        repeated = 0
+        whole = 0  # characters of the chunks entirely within the range
+        cut = 0  # chunks crossing either end of the range
+        seen = set()
+        for page in range(from_page, to_page + 1):
+            page_counts = counts[page]
+            words += page_counts["words"]
+            removed += page_counts["removed"]
+            page_chars += page_counts["chars"]
+            for digest, length, first_page in page_counts["chunks"]:
+                if first_page < from_page:
+                    cut += 1
+                    continue
+                whole += length
+                # Repeated chunks reuse the audio of their first copy and are not billed.
+                if digest in seen:
+                    repeated += length
+                    continue
+                seen.add(digest)
+                characters += length
+                chunks += 1
+        following = _next_chunk(counts, to_page)
+        if following is not None and following[2] <= to_page:
+            cut += 1
+        if cut or page_chars > whole:
+            # What is left of the cut chunks may fit in fewer requests than there are cuts.
+            left = max(page_chars - whole, 0)
+            characters += left
+            chunks += max(min(cut, math.ceil(left / max_chars)), 1)
+
+        return {
+            "characters": characters,
+            "chunks": chunks,
+            "removed_characters": removed,
+            "repeated_characters": repeated,
+            "price_cents": characters / 1000000 * CENTS_PER_MILLION_CHARS,
+            "duration_seconds": words / (WORDS_PER_MINUTE * speed) * 60,
+        }
+
+    def _count(self, index, from_page, to_page, max_chars, clean_text, counts):
+        """
+        Cleans and chunks a page range, storing the counts of each page in counts.
+        """
+        page_counts = {}
+        raw_texts = deque()
+        current_page = from_page
+
+        def read():
+            for record in index.iter_pages(from_page, to_page):
+                raw_texts.append(record["text"])
+                yield record["text"]
+
+        def texts():
+            nonlocal current_page
+            cleaned = TextCleaner().clean(read()) if clean_text else read()
+            for current_page, text in enumerate(cleaned, start=from_page):
+                raw = raw_texts.popleft()
+                page_counts[current_page] = {
+                    "words": len(text.split()),
+                    "chars": _spoken_length(text),
+                    "removed": _spoken_length(raw) - _spoken_length(text),
+                    "chunks": [],
+                }
+                yield text
+
+        # A chunk belongs to the page the chunker was reading when it completed it, and
+        # starts on the page the chunk before it was completed on.
+        first_page = from_page
+        for chunk in iter_sentence_chunks(texts(), max_chars):
+            page_counts[current_page]["chunks"].append(
+                (hash(" ".join(chunk.split())), len(chunk), first_page))
+            first_page = current_page
+
+        with _page_counts_lock:
+            counts.update(page_counts)
+
+
+def get_estimator(pdf_path):
+    """
+    Returns an estimator for a PDF file.
+    """
+    return PriceEstimator(pdf_path)
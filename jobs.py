@@ -0,0 +1,345 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+JOBS_DIR = "jobs"
+
+# Job directories untouched for this long are treated as abandoned and deleted.
+MAX_JOB_AGE_SECONDS = 7 * 24 * 60 * 60
+
+PENDING = "pending"
+DONE = "done"
+APPENDED = "appended"
+
+
+_file_hashes = {}
+
+
+def file_hash(path):
+    """
+    Returns the SHA-256 hex digest of a file's contents. The digest is remembered
+    until the file's size or modification time changes.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key in _file_hashes:
+        return _file_hashes[key]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+
+def _lock(file):
+    """
+    Takes a non-blocking exclusive lock on an open file. The operating system drops
+    the lock when the process exits, so a crashed job never leaves a stale lock.
+
+    Raises:
+    - OSError: If another handle already holds the lock.
+    """
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _spoken_hash(text):
+    # Chunks differing only in whitespace sound the same.
+    return text_hash(" ".join(text.split()))
+
+
+def job_id(pdf_path, pdf_from, pdf_to, voice, model, speed=1.0, output_format="mp3",
+           clean_text=True):
+    """
+    Identifies a conversion by the PDF contents, page range, voice, model, speed,
+    output format and whether the text is cleaned up, so running the same conversion
+    again finds the same job.
+    """
+    key = f"{file_hash(pdf_path)}:{pdf_from}:{pdf_to}:{voice}:{model}"
+    # Cleaned MP3 jobs at normal speed keep the ids they had before any of these
+    # were configurable.
+    if speed != 1.0:
+        key += f":{float(speed)!r}"
+    if output_format != "mp3":
+        key += f":{output_format}"
+    if not clean_text:
+        key += ":raw"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def prune_jobs(jobs_dir=JOBS_DIR, max_age=MAX_JOB_AGE_SECONDS):
+    """
+    Deletes job directories that have not been written to for max_age seconds and are
+    not locked by a running job.
+    """
+    if not os.path.isdir(jobs_dir):
+        return
+    now = time.time()
+    for name in os.listdir(jobs_dir):
+        directory = os.path.join(jobs_dir, name)
+        manifest_path = os.path.join(directory, "manifest.json")
+        try:
+            if now - os.path.getmtime(manifest_path) < max_age:
+                continue
+            with open(os.path.join(directory, "lock"), "a") as lock_file:
+                _lock(lock_file)
+                shutil.rmtree(directory, ignore_errors=True)
+        except OSError:
+            continue
+
+
+class JobManifest:
+    """
+    Records the progress of one conversion in <jobs_dir>/<job_id>/manifest.json.
+
+    The job directory is the job's private workspace: its chunk audio and partial output
+    live there and nowhere else, and it is locked while the job runs so two processes
+    can never work on it at once. Use the manifest as a context manager to release the
+    lock when the job stops.
+
+    The manifest holds the page range, the boundaries of every chunk produced so far
+    (its length and a hash of its text) and each chunk's status: pending, done (audio
+    saved in the job directory) or appended (audio written to the partial output).
+    Appended chunks also record where their audio sits in the partial output, and a
+    chunk that repeats the text of an earlier one records which one as duplicate_of,
+    so its audio can be copied instead of synthesized again.
+    It is rewritten whenever a chunk changes status, so a job that is killed part way
+    through can pick up where it stopped.
+    """
+
+    def __init__(self, directory, data):
+        self.directory = directory
+        self.data = data
+        # Held for every change to data and while it is saved, since worker threads
+        # mark chunks done while the main thread records and appends others.
+        self._lock = threading.RLock()
+        self._lock_file = None
+        # Index of the first chunk with each spoken text, rebuilt as chunks are recorded.
+        self._first_by_text = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, "manifest.json")
+
+    @property
+    def output_path(self):
+        """
+        Where the audio of appended chunks is collected until the job finishes.
+        """
+        return os.path.join(self.directory, f"output.{self.response_format}.part")
+
+    @property
+    def response_format(self):
+        """
+        The format chunks are synthesized in. Jobs from before it was recorded are MP3.
+        """
+        return self.data.get("response_format", "mp3")
+
+    @property
+    def chunks(self):
+        return self.data["chunks"]
+
+    @property
+    def appended(self):
+        """
+        Number of chunks, counted from the first, already written to the partial output.
+        """
+        count = 0
+        for chunk in self.chunks:
+            if chunk["status"] != APPENDED:
+                break
+            count += 1
+        return count
+
+    @property
+    def bytes_written(self):
+        return self.data["bytes_written"]
+
+    @classmethod
+    def open(cls, pdf_path, pdf_from, pdf_to, voice="alloy", model="tts-1", jobs_dir=JOBS_DIR,
+             speed=1.0, output_format="mp3", response_format="mp3", clean_text=True):
+        """
+        Loads and locks the manifest of a matching earlier job, or starts a new one.
+        Abandoned jobs of other conversions are cleaned up first.
+
+        Chunks marked done whose audio file has since disappeared are marked pending again.
+
+        Args:
+        - output_format (str): The format of the finished file.
+        - response_format (str): The format chunks are synthesized in, which is also
+          the format of the partial output.
+        - clean_text (bool): Whether the text is cleaned up before it is chunked.
+
+        Returns:
+        - JobManifest: The job's manifest.
+
+        Raises:
+        - RuntimeError: If the same conversion is already running.
+        """
+        prune_jobs(jobs_dir)
+        directory = os.path.join(
+            jobs_dir, job_id(pdf_path, pdf_from, pdf_to, voice, model, speed, output_format,
+                             clean_text))
+        os.makedirs(directory, exist_ok=True)
+        lock_file = open(os.path.join(directory, "lock"), "a")
+        try:
+            _lock(lock_file)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError("This conversion is already running.")
+
+        manifest_path = os.path.join(directory, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as file:
+                job = cls(directory, json.load(file))
+            job._lock_file = lock_file
+            for chunk in job.chunks:
+                if chunk["status"] == DONE and not os.path.exists(chunk["audio_path"]):
+                    chunk["status"] = PENDING
+            return job
+
+        job = cls(directory, {
+            "pdf_path": os.path.abspath(pdf_path),
+            "pdf_from": pdf_from,
+            "pdf_to": pdf_to,
+            "voice": voice,
+            "model": model,
+            "speed": speed,
+            "output_format": output_format,
+            "response_format": response_format,
+            "clean_text": clean_text,
+            "bytes_written": 0,
+            "chunks": [],
+        })
+        job._lock_file = lock_file
+        job.save()
+        return job
+
+    def close(self):
+        """
+        Releases the job's lock, keeping its progress for a later run.
+        """
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def save(self):
+        with self._lock:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as file:
+                json.dump(self.data, file, indent=2)
+            os.replace(temp_path, self.path)
+
+    def record_chunk(self, index, text, chapter=None):
+        """
+        Records the boundaries of the chunk at index, or checks them against an earlier run.
+
+        If an earlier run produced a different chunk at this index, that chunk and
+        every one after it are discarded (see truncate) and the job carries on from
+        here, keeping the audio of the chunks before it.
+
+        Args:
+        - index (int): The chunk's position in the job.
+        - text (str): The chunk's text.
+        - chapter (int): The index of the chapter the chunk belongs to, if the job is
+          split into chapters.
+
+        Returns:
+        - dict: The chunk's manifest entry.
+        """
+        digest = text_hash(text)
+        first = self._first_by_text.setdefault(_spoken_hash(text), index)
+        if index < len(self.chunks):
+            chunk = self.chunks[index]
+            if chunk["sha256"] == digest:
+                return chunk
+            print(f"The text from chunk {index + 1} on no longer matches the earlier run; "
+                  f"converting it again")
+            self.truncate(index)
+
+        chunk = {
+            "index": index,
+            "chars": len(text),
+            "sha256": digest,
+            "audio_path": os.path.join(self.directory,
+                                       f"part{index + 1}.{self.response_format}"),
+            "status": PENDING,
+            "duplicate_of": first if first != index else None,
+        }
+        if chapter is not None:
+            chunk["chapter"] = chapter
+        with self._lock:
+            self.chunks.append(chunk)
+        return chunk
+
+    def mark_done(self, index):
+        with self._lock:
+            self.chunks[index]["status"] = DONE
+            self.save()
+
+    def mark_appended(self, index, bytes_written):
+        with self._lock:
+            chunk = self.chunks[index]
+            chunk["status"] = APPENDED
+            chunk["offset"] = self.data["bytes_written"]
+            chunk["length"] = bytes_written - chunk["offset"]
+            self.data["bytes_written"] = bytes_written
+            self.save()
+
+    def duplicates(self):
+        """
+        Returns the number of chunks recorded so far that repeat an earlier chunk, and
+        their total number of characters.
+        """
+        repeated = [chunk for chunk in self.chunks if chunk.get("duplicate_of") is not None]
+        return len(repeated), sum(chunk["chars"] for chunk in repeated)
+
+    def truncate(self, index):
+        """
+        Forgets the chunk at index and every chunk after it, deleting their audio and
+        cutting the partial output back to where their audio started.
+
+        Only chunks that have not been handed out for synthesis in this run may be
+        dropped.
+        """
+        with self._lock:
+            dropped = self.chunks[index:]
+            del self.chunks[index:]
+            if dropped and dropped[0]["status"] == APPENDED:
+                self.data["bytes_written"] = dropped[0]["offset"]
+            for chunk in dropped:
+                if os.path.exists(chunk["audio_path"]):
+                    os.remove(chunk["audio_path"])
+            if os.path.exists(self.output_path):
+                os.truncate(self.output_path, self.data["bytes_written"])
+            self.save()
+
+    def remove(self):
+        """
+        Deletes the job directory once its output has been written.
+        """
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -1,162 +1,186 @@
 import os
-import sys
-import fitz  # Import the PyMuPDF library
-from pathlib import Path
+import time
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import closing, nullcontext
+from itertools import groupby
 from dotenv import load_dotenv
-from openai import OpenAI
 from pydub import AudioSegment
 
+from api_client import connection_stats
+from audio import (OUTPUT_FORMATS, append_audio, audio_duration, concat_mp3_ffmpeg,
+                   concat_mp3_frames, encode_output, write_wav)
+from cache import SynthesisCache
+from chapters import get_chapters
+from chunking import MAX_INPUT_CHARS, iter_sentence_chunks
+from estimate import CHARS_PER_SECOND, get_estimator
+from jobs import APPENDED, PENDING, JobManifest
+from metrics import Metrics, profiling
+from normalize import TextCleaner
+from page_index import get_page_index
+from scheduler import RequestScheduler
+from tts_backends import get_backend
+
 load_dotenv()
 
+# Length of the audio synthesized by preview_audio, in seconds.
+PREVIEW_SECONDS = 30
 
-def split_pdf(pdf_path, from_page, to_page):
-    """
-    Splits a PDF file, creating a new PDF file from a specified range of pages.
 
-    This function opens a PDF file from the given path, extracts a range of pages specified
-    by the from_page and to_page parameters, and saves the extracted pages into a new PDF file. 
-    The path of the newly created PDF file is then returned.
+def synthesize_text(backend, scheduler, text, output_file_path, voice="alloy", model="tts-1",
+                    cache=None, metrics=None, speed=1.0, response_format="mp3"):
+    """
+    Converts one chunk of text to speech and saves it as an .mp3 file, or in
+    response_format.
 
-    Parameters:
-    - pdf_path (str): The path to the PDF file to be split.
-    - from_page (int): The starting page number for the split (zero-based indexing).
-    - to_page (int): The ending page number for the split (zero-based indexing). 
-      The page corresponding to this number will be included in the split.
+    Args:
+    - backend (TTSBackend): The speech engine to synthesize with.
+    - scheduler (RequestScheduler): Rate limits and retries the speech request.
+    - text (str): The text to speak.
+    - output_file_path (str): Where to save the audio.
+    - voice (str): The voice to speak with. Default is "alloy".
+    - model (str): The TTS model to use. Default is "tts-1".
+    - cache (SynthesisCache): Cache to reuse audio from, or None.
+    - metrics (Metrics): Records the cache lookup, the time spent waiting on the
+      scheduler and every request attempt with its latency. Optional.
+    - speed (float): How fast to speak, 1.0 being normal speed.
+    - response_format (str): The audio format to synthesize, such as "mp3", "aac"
+      or "pcm". Default is "mp3".
 
     Returns:
-    - str: The path to the newly created PDF file containing the specified page range.
-
-    Raises:
-    - Exception: If any error occurs during the opening, splitting, or saving of the PDF file.
-
-    Note:
-    The `fitz` module, part of PyMuPDF, is used for handling PDF operations.
+    - str: Path to the generated audio file.
     """
-    try:
-        doc = fitz.open(pdf_path)
-        split_doc = fitz.open()
-        split_doc.insert_pdf(doc, from_page=from_page, to_page=to_page)
-
-        output_path = "pdfs/temp_split_pdf.pdf"
-        split_doc.save(output_path)
-        return output_path
-    except Exception as e:
-        print(e)
+    if metrics is None:
+        metrics = Metrics()
+    if cache is not None:
+        with metrics.stage("cache_lookup") as counters:
+            hit = cache.get(text, voice, model, output_file_path, speed, response_format)
+            counters["hits" if hit else "misses"] = 1
+        if hit:
+            return output_file_path
+
+    partial_path = output_file_path + ".part"
+
+    def request():
+        # The audio is written to disk as it arrives rather than held in memory. It goes
+        # to a temporary file first, so a request retried part way through the download
+        # never leaves half a chunk behind.
+        start = time.perf_counter()
+        with metrics.stage("tts_request", chars=len(text)) as counters:
+            with open(partial_path, "wb") as file:
+                backend.synthesize(text, file, voice, model, response_format, speed)
+                counters["bytes"] = file.tell()
+        seconds = time.perf_counter() - start
+        metrics.observe("tts_request", seconds)
+        metrics.emit("request", seconds=round(seconds, 6), chars=len(text),
+                     bytes=counters.get("bytes", 0))
+        os.replace(partial_path, output_file_path)
 
-
-def pdf_to_text(pdf_path, txt_path):
+    try:
+        # Time spent here outside the request itself is rate limiting and backoff.
+        with metrics.stage("scheduler_wait"):
+            scheduler.run(request, chars=len(text))
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    if cache is not None:
+        with metrics.stage("cache_store"):
+            cache.put(text, voice, model, output_file_path, speed, response_format)
+    return output_file_path
+
+
+def check_page_range(pdf_path, pdf_from, pdf_to):
     """
-    Converts a PDF file to a text file.
+    Checks that a page range is within a PDF file before any work is done with it.
 
     Args:
-    - pdf_path (str): The path to the input PDF file.
-    - txt_path (str): The path where the output text file will be saved.
-    """
-    with fitz.open(pdf_path) as doc:
-        with open(txt_path, "w") as txt_file:
-            for page in doc:
-                text = page.get_text()
-                txt_file.write(text)
+    - pdf_path (str): Path to the PDF file.
+    - pdf_from (int): First page (zero-based, inclusive).
+    - pdf_to (int): Last page (zero-based, inclusive).
 
+    Returns:
+    - int: The number of pages in the PDF.
 
-def split_text_file_into_chunks(file_path, max_chars=4000):
+    Raises:
+    - ValueError: Unless 0 <= pdf_from <= pdf_to < the number of pages.
     """
-    Splits the content of a text file into smaller files each containing up to max_chars characters without splitting words.
+    page_count = get_page_index(pdf_path).page_count
+    if not 0 <= pdf_from <= pdf_to < page_count:
+        raise ValueError(f"Invalid page range {pdf_from} to {pdf_to}: pages are numbered from "
+                         f"0 to {page_count - 1} and the first must not be after the last")
+    return page_count
 
-    Args:
-    - file_path (str): The path to the input text file.
-    - max_chars (int): Maximum number of characters for each smaller file. Default is 4000.
 
-    Returns:
-    - list: Paths to the generated smaller text files.
+def _resolve_backend(backend, voice, model, speed, response_format="mp3"):
     """
-    chunk = []
-    chunk_size = 0
-    file_counter = 1
-    output_files = []
-
-    output_dir = os.path.dirname(file_path)
-    base_name = os.path.splitext(os.path.basename(file_path))[0]
-
-    with open(file_path, 'r') as file:
-        for word in file.read().split():
-            word_size = len(word) + 1
-
-            if chunk_size + word_size > max_chars:
-                output_file_path = os.path.join(
-                    output_dir, f"{base_name}_part{file_counter}.txt")
-                with open(output_file_path, 'w') as output_file:
-                    output_file.write(' '.join(chunk))
-                output_files.append(output_file_path)
+    Returns the speech engine named by backend with the voice and model to use, filling
+    in the engine's defaults for any left as None.
 
-                chunk = []
-                chunk_size = 0
-                file_counter += 1
-
-            chunk.append(word)
-            chunk_size += word_size
-
-        if chunk:
-            output_file_path = os.path.join(
-                output_dir, f"{base_name}_part{file_counter}.txt")
-            with open(output_file_path, 'w') as output_file:
-                output_file.write(' '.join(chunk))
-            output_files.append(output_file_path)
-
-    return output_files
+    Raises:
+    - ValueError: If the engine does not support the model, format or speed.
+    """
+    backend = get_backend(backend)
+    voice = voice or backend.voices[0]
+    model = model or backend.models[0]
+    backend.check(voice, model, response_format, speed)
+    return backend, voice, model
 
 
-def convert_texts_to_speech(file_paths):
+def _ordered_map(executor, func, items, window):
     """
-    Takes an array of file paths, reads the text from each file, and uses the OpenAI API
-    to convert the text to speech, saving each output as a new .mp3 file.
+    Like executor.map, but pulls at most window items from items ahead of the result
+    being waited on, so a lazy iterable is only consumed as fast as results are used.
 
-    Args:
-    - file_paths (list of str): Paths to the text files to be converted.
-
-    Returns:
-    - None
-    """
-    client = OpenAI()
-
-    mp3_paths = []
-    for file_path in file_paths:
-        # Read the text from the file
-        try:
-            with open(file_path, "r") as file:
-                file_text = file.read()
-        except FileNotFoundError:
-            print(f"File {file_path} not found. Skipping.")
-            continue
-
-        # Generate speech from the text
-        try:
-            response = client.audio.speech.create(
-                model="tts-1",
-                voice="alloy",
-                input=file_text
-            )
-
-            # Naming the output file based on the original file path, but with .mp3 extension
-            output_file_path = str(Path(file_path).with_suffix('.mp3'))
-            mp3_paths.append(output_file_path)
-
-            # Saving the audio to a file
-            response.stream_to_file(output_file_path)
-            print(f"Generated speech saved to {output_file_path}")
-        except Exception as e:
-            print(f"Failed to generate speech for {file_path}: {e}")
-    return mp3_paths
-
-
-def stitch_mp3_files(file_paths, output_file_path):
+    When the results stop being used, because a result raised or the generator was
+    closed, work that has not started is cancelled and work already running is
+    waited for, so none of it outlives the caller.
+    """
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        wait(pending)
+
+
+def stitch_mp3_files(file_paths, output_file_path, mode="frames", metrics=None):
     """
     Concatenates multiple MP3 files into a single MP3 file.
 
     Args:
     - file_paths (list of str): Paths to the MP3 files to be concatenated.
     - output_file_path (str): Path where the output MP3 file will be saved.
+    - mode (str): How to join the files. Default is "frames".
+      - "frames": copies the MP3 frames of each file straight into the output. Nothing
+        is decoded or re-encoded and memory use does not grow with the number of files.
+      - "ffmpeg": joins the files in one ffmpeg pass without re-encoding.
+      - "reencode": decodes every file with pydub and encodes the result again.
+    - metrics (Metrics): Records the time taken and the bytes written. Optional.
     """
+    if metrics is None:
+        metrics = Metrics()
+    with metrics.stage("stitch", files=len(file_paths)) as counters:
+        _stitch(file_paths, output_file_path, mode)
+        counters["bytes"] = os.path.getsize(output_file_path)
+
+
+def _stitch(file_paths, output_file_path, mode):
+    if mode == "frames":
+        concat_mp3_frames(file_paths, output_file_path)
+        return
+    if mode == "ffmpeg":
+        concat_mp3_ffmpeg(file_paths, output_file_path)
+        return
+    if mode != "reencode":
+        raise ValueError(f"Unknown stitch mode: {mode}")
+
     combined = AudioSegment.from_mp3(file_paths[0])
 
     for file_path in file_paths[1:]:
@@ -166,69 +190,382 @@ def stitch_mp3_files(file_paths, output_file_path):
     combined.export(output_file_path, format="mp3")
 
 
-def gen_audio(pdf_path, output_mp3_path, output_file_name, pdf_from, pdf_to):
+def gen_audio(pdf_path, output_mp3_path, output_file_name, pdf_from, pdf_to,
+              voice=None, model=None, max_workers=None, clean_text=True,
+              scheduler=None, executor=None, on_progress=None, cancel_event=None,
+              preview_dir=None, metrics=None, profile=None, backend="openai", speed=1.0,
+              output_format="mp3"):
     """
-    Main function to convert a PDF file to an MP3 file.
+    Main function to convert a PDF file to an MP3 file, or another audio format.
+
+    The conversion runs as a pipeline: pages are read a few at a time (from the PDF's
+    page index when they were extracted before), running headers, footers, page numbers
+    and line-break hyphens are removed, the text is packed into chunks that
+    end at sentence boundaries, each chunk is sent for synthesis as soon as it is full,
+    and finished audio is appended to the output in chunk order as it arrives. Only a
+    few chunks are ever held at once, however long the page range is.
+
+    Progress is recorded in a job manifest under jobs/. If an earlier run of the same
+    conversion was interrupted, its appended audio is kept and only the chunks it did
+    not finish are synthesized.
+
+    MP3 and AAC output is the synthesized audio joined as it is. WAV, FLAC and Opus
+    output is synthesized as raw PCM and encoded once, when every chunk is done, and
+    M4B output is an audiobook of the AAC audio with a chapter marker at the start of
+    every chapter (see chapters.get_chapters). Its chunks never span two chapters.
+    Every format but MP3, AAC and WAV needs ffmpeg.
 
     Args:
     - pdf_path (str): Path to the input PDF file.
-    - output_mp3_path (str): Path where the output MP3 file will be saved.
+    - output_mp3_path (str): Path where the output file will be saved.
+    - output_file_name (str): Name of the output file, without extension.
+    - pdf_from (int): First page to convert (zero-based, inclusive).
+    - pdf_to (int): Last page to convert (zero-based, inclusive).
+    - voice (str): The voice to speak with. Defaults to the engine's first voice,
+      "alloy" for the OpenAI API.
+    - model (str): The TTS model to use. Defaults to the engine's first model, "tts-1"
+      for the OpenAI API.
+    - max_workers (int): Maximum number of concurrent speech requests. Defaults to the
+      engine's: 4 for the OpenAI API and one per core for local engines.
+    - clean_text (bool): Remove headers, footers and other boilerplate before
+      synthesis. Default is True.
+    - scheduler (RequestScheduler): Scheduler to send requests through. A new one is
+      created when omitted; pass one in to share rate limits between conversions.
+    - executor (Executor): Where chunks are synthesized. A pool of max_workers threads
+      is created when omitted; pass one in to share a worker pool between conversions.
+    - on_progress (callable): Called with a dict describing each step of the
+      conversion, always from the thread that called gen_audio. The dict's "event" is
+      - "start": with "pages" in the range, and the number of "resumed_chunks" and
+        their "resumed_chars" already written by an earlier run.
+      - "page": a page was read, with its "page" number and "pages_read" so far.
+      - "chunk": a chunk was written to the output, with its "index", "chars",
+        whether it was "repeated", the output's "bytes_written" and, with a
+        preview_dir, the chunk's "preview_path".
+      - "done": with the "output" path, number of "chunks" and "bytes_written".
+    - cancel_event (threading.Event): Stops the conversion when set. No new requests
+      are sent, requests already in flight are allowed to finish and their audio kept,
+      and the job's progress is saved so running the conversion again resumes it.
+    - preview_dir (str): Folder to also save each chunk's audio in, as
+      preview_0001.mp3 and so on, as soon as it is written to the output. Chunks
+      finish in order, so they can be played one after another while the rest of the
+      book is still being converted. AAC chunks are saved as .aac files, and the raw
+      PCM of WAV, FLAC and Opus conversions as .wav files.
+    - metrics (Metrics): Collects the wall time and counters of every stage (extract,
+      clean, chunk, cache_lookup, scheduler_wait, tts_request, wait, append and
+      finalize) and the latency of every request, and sends them to its sinks. A
+      breakdown is printed at the end either way.
+    - profile (str): "cprofile" or "tracemalloc" to profile the conversion, see
+      metrics.profiling. Defaults to the TTS_PROFILE environment variable.
+    - backend (str or TTSBackend): The speech engine, "openai" or "espeak" (see
+      tts_backends). Local engines have no rate limits and cost nothing. Default is
+      "openai".
+    - speed (float): How fast to speak, 1.0 being normal speed.
+    - output_format (str): "mp3", "aac", "m4b", "wav", "flac" or "opus". Default is
+      "mp3".
+
+    Returns:
+    - str: Path to the generated audio file.
+
+    Raises:
+    - ValueError: If the page range is not within the PDF or has no text, the output
+      format is unknown, or the engine does not support the model or speed.
+    - RuntimeError: If the conversion was cancelled, or ffmpeg is needed and fails.
+      Either way, running the conversion again resumes it.
     """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}; "
+                         f"use one of {', '.join(OUTPUT_FORMATS)}")
+    response_format = OUTPUT_FORMATS[output_format]
+    backend, voice, model = _resolve_backend(backend, voice, model, speed, response_format)
+    check_page_range(pdf_path, pdf_from, pdf_to)
+    max_workers = max_workers or backend.max_workers
+    if metrics is None:
+        metrics = Metrics()
+    profile = profile or os.getenv("TTS_PROFILE") or None
     try:
-        # split pdf by page
-        split_pdf_file_path = split_pdf(pdf_path, pdf_from, pdf_to)
-        # Convert PDF to text
-        txt_path = split_pdf_file_path.replace('.pdf', '.txt')
-        pdf_to_text(split_pdf_file_path, txt_path)
-
-        # Split the text file into chunks
-        chunk_files = split_text_file_into_chunks(txt_path)
-
-        # Convert text chunks to speech (MP3)
-        mp3_files = convert_texts_to_speech(chunk_files)
-        # mp3_files = ["mp3/output_part1.mp3"]
-
-        # Stitch the MP3 files into a single file
-        output_file_path = f"{output_mp3_path}/{output_file_name}.mp3"
-        stitch_mp3_files(mp3_files, output_file_path)
-        return output_file_path
+        with profiling(profile, metrics=metrics), \
+                JobManifest.open(pdf_path, pdf_from, pdf_to, voice, model, speed=speed,
+                                 output_format=output_format,
+                                 response_format=response_format,
+                                 clean_text=clean_text) as job:
+            return _run_job(job, pdf_path, output_mp3_path, output_file_name,
+                            pdf_from, pdf_to, voice, model, max_workers, clean_text,
+                            scheduler, executor, on_progress, cancel_event, preview_dir,
+                            metrics, backend, speed, output_format)
     except Exception as e:
         raise e
+    finally:
+        print(metrics.summary())
 
 
-def calculate_price_from_file(file_path):
-    try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
-            num_characters = len(content)
-            price_cents = (num_characters / 1000000) * 1500
-            return price_cents
-    except Exception as e:
-        return {"success": False, "error": str(e)}
+def _run_job(job, pdf_path, output_mp3_path, output_file_name, pdf_from, pdf_to,
+             voice, model, max_workers, clean_text, scheduler=None, executor=None,
+             on_progress=None, cancel_event=None, preview_dir=None, metrics=None,
+             backend="openai", speed=1.0, output_format="mp3"):
+    """
+    Runs the conversion pipeline for a locked job, as described in gen_audio.
+    """
+    def check_cancelled():
+        if cancel_event is not None and cancel_event.is_set():
+            raise RuntimeError("The conversion was cancelled.")
+
+    def progress(event, **fields):
+        if on_progress is not None:
+            on_progress({"event": event, **fields})
+
+    resume_from = job.appended
+    if resume_from:
+        print(f"Resuming after {resume_from} chunks already written")
+    page_index = get_page_index(pdf_path)
+    progress("start", pages=pdf_to - pdf_from + 1,
+             resumed_chunks=resume_from,
+             resumed_chars=sum(chunk["chars"] for chunk in job.chunks[:resume_from]))
+
+    backend = get_backend(backend)
+    if scheduler is None:
+        scheduler = RequestScheduler(max_concurrency=max_workers,
+                                     rate_limit=backend.rate_limited)
+    if metrics is None:
+        metrics = Metrics()
+    cache = SynthesisCache()
+    cleaner = TextCleaner()
+    retries_before = scheduler.stats["retries"]
+    response_format = job.response_format
+    chapters = get_chapters(pdf_path, pdf_from, pdf_to) if output_format == "m4b" else None
+
+    def chunks():
+        # Chunk boundaries are recorded as the text is read, and checked
+        # against the earlier run for chunks that were already written.
+        pages = metrics.timed("extract", page_index.iter_texts(pdf_from, pdf_to),
+                              lambda text: {"pages": 1, "chars": len(text)})
+        pages = _report_pages(pages, pdf_from, progress)
+        if clean_text:
+            pages = metrics.timed("clean", cleaner.clean(pages),
+                                  lambda text: {"chars": len(text)})
+        if chapters is None:
+            texts = ((None, text) for text in iter_sentence_chunks(pages))
+        else:
+            texts = _iter_chapter_chunks(pages, pdf_from, chapters)
+        texts = metrics.timed("chunk", texts, lambda item: {"chunks": 1, "chars": len(item[1])})
+        for index, (chapter, text) in enumerate(texts):
+            chunk = job.record_chunk(index, text, chapter)
+            # A chunk that no longer matches the earlier run is recorded afresh, so it
+            # is converted again even if the earlier run had written it.
+            if chunk["status"] != APPENDED:
+                yield chunk, text
+
+    def synthesize(item):
+        chunk, text = item
+        # Repeated chunks are copied from the output once their first copy is in it.
+        if chunk["status"] == PENDING and chunk.get("duplicate_of") is None:
+            check_cancelled()
+            synthesize_text(backend, scheduler, text, chunk["audio_path"], voice, model, cache,
+                            metrics, speed, response_format)
+            job.mark_done(chunk["index"])
+        return chunk
+
+    # A shared executor is left running for the other conversions using it.
+    pool = ThreadPoolExecutor(max_workers=max_workers) if executor is None \
+        else nullcontext(executor)
+    # Closing the synthesis results when the loop ends, however it ends, waits for
+    # the chunks in flight, so none of them touches the job after it is released.
+    with open(job.output_path, "ab") as output, pool as executor, \
+            closing(_ordered_map(executor, synthesize, chunks(),
+                                 window=2 * max_workers)) as ordered:
+        # Drop anything written after the last chunk the manifest knows about.
+        output.truncate(job.bytes_written)
+        # Time spent in this loop's next() outside the reading stages is spent
+        # waiting for synthesis.
+        for chunk in metrics.timed("wait", ordered):
+            check_cancelled()
+            with metrics.stage("append") as counters:
+                if chunk.get("duplicate_of") is not None:
+                    _append_output_range(output, job.chunks[chunk["duplicate_of"]], output.name)
+                else:
+                    append_audio(output, chunk["audio_path"], response_format)
+                    os.remove(chunk["audio_path"])
+                output.flush()
+                counters["bytes"] = output.tell() - job.bytes_written
+                job.mark_appended(chunk["index"], output.tell())
+            metrics.emit("chunk", index=chunk["index"], chars=chunk["chars"],
+                         bytes=counters["bytes"])
+            print(f"Appended chunk {chunk['index'] + 1} to the output")
+            preview = {}
+            if preview_dir is not None:
+                preview["preview_path"] = _write_preview(preview_dir, chunk, output.name,
+                                                         response_format)
+            progress("chunk", index=chunk["index"], chars=chunk["chars"],
+                     repeated=chunk.get("duplicate_of") is not None,
+                     bytes_written=job.bytes_written, **preview)
+
+    if not job.chunks:
+        job.remove()
+        raise ValueError("There is no text to convert in these pages.")
+    print(cache.summary())
+    print(connection_stats.summary())
+    repeated, repeated_chars = job.duplicates()
+    if repeated:
+        print(f"Reused audio for {repeated} repeated chunks, saving {repeated_chars} characters")
+    if clean_text:
+        print(f"Cleanup removed {cleaner.stats['boilerplate_lines']} header and footer lines "
+              f"and about {cleaner.stats['chars_removed']} billable characters")
+    metrics.count("scheduler_wait", retries=scheduler.stats["retries"] - retries_before)
+    output_file_path = f"{output_mp3_path}/{output_file_name}.{output_format}"
+    bytes_written = job.bytes_written
+    with metrics.stage("finalize"):
+        chapter_times = _chapter_times(job, chapters) if chapters is not None else ()
+        encode_output(job.output_path, output_file_path, output_format, chapter_times,
+                      title=output_file_name)
+        job.remove()
+    progress("done", output=output_file_path, chunks=len(job.chunks), bytes_written=bytes_written)
+    return output_file_path
+
+
+def _iter_chapter_chunks(texts, pdf_from, chapters):
+    """
+    Packs a stream of page texts into chunks one chapter at a time, so no chunk holds
+    the end of one chapter and the start of the next.
+
+    Yields:
+    - tuple: The index of the chapter in chapters and the text of one chunk.
+    """
+    starts = [chapter["from"] for chapter in chapters]
+    pages = enumerate(texts, start=pdf_from)
+    for chapter, group in groupby(pages, key=lambda page: bisect_right(starts, page[0]) - 1):
+        for text in iter_sentence_chunks(text for _, text in group):
+            yield chapter, text
+
+
+def _chapter_times(job, chapters):
+    """
+    Measures where each chapter starts and ends in a job's partial output, from the
+    chunks appended to it.
+
+    Returns:
+    - list of dict: The "title", "start" and "end" in seconds of every chapter with
+      any audio, in order.
+    """
+    starts = {}
+    position = 0.0
+    with open(job.output_path, "rb") as output:
+        for chunk in job.chunks:
+            output.seek(chunk["offset"])
+            starts.setdefault(chunk.get("chapter"), position)
+            position += audio_duration(output.read(chunk["length"]), job.response_format)
+    indexes = sorted(index for index in starts if index is not None)
+    ends = [starts[index] for index in indexes[1:]] + [position]
+    return [{"title": chapters[index]["title"], "start": starts[index], "end": end}
+            for index, end in zip(indexes, ends)]
+
+
+def _write_preview(preview_dir, chunk, source_path, response_format):
+    """
+    Saves a copy of an appended chunk's audio to play on its own, and returns its path.
+    Raw PCM is saved as WAV.
+    """
+    name = f"preview_{chunk['index'] + 1:04d}"
+    if response_format == "pcm":
+        path = os.path.join(preview_dir, f"{name}.wav")
+        write_wav(source_path, path, chunk["offset"], chunk["length"])
+        return path
+    path = os.path.join(preview_dir, f"{name}.{response_format}")
+    with open(path, "wb") as preview_file:
+        _append_output_range(preview_file, chunk, source_path)
+    return path
+
+
+def _report_pages(texts, pdf_from, progress):
+    for pages_read, text in enumerate(texts, start=1):
+        progress("page", page=pdf_from + pages_read - 1, pages_read=pages_read)
+        yield text
+
+
+def preview_audio(pdf_path, pdf_from, pdf_to, output_file_path, seconds=PREVIEW_SECONDS,
+                  voice=None, model=None, clean_text=True, backend="openai", speed=1.0):
+    """
+    Synthesizes only the start of a conversion, to check the voice and page range
+    before paying for the whole book.
 
+    The text is prepared exactly as gen_audio prepares it, and cut at the end of the
+    sentence that brings it to about the given number of seconds of speech. Previews
+    go through the audio cache, so asking for the same one again costs nothing.
 
-def get_price(pdf_path, pdf_from, pdf_to):
+    Args:
+    - pdf_path (str): Path to the input PDF file.
+    - pdf_from (int): First page to convert (zero-based, inclusive).
+    - pdf_to (int): Last page to convert (zero-based, inclusive).
+    - output_file_path (str): Where to save the preview MP3 file.
+    - seconds (float): Approximate length of the preview. Default is 30 seconds.
+    - voice (str): The voice to speak with. Defaults to the engine's first voice.
+    - model (str): The TTS model to use. Defaults to the engine's first model.
+    - clean_text (bool): Remove headers, footers and other boilerplate first, as
+      gen_audio does by default. Default is True.
+    - backend (str or TTSBackend): The speech engine. Default is "openai".
+    - speed (float): How fast to speak, 1.0 being normal speed.
+
+    Returns:
+    - str: Path to the preview MP3 file.
+
+    Raises:
+    - ValueError: If the page range is not within the PDF or has no text, or the
+      engine does not support the model or speed.
+    """
+    backend, voice, model = _resolve_backend(backend, voice, model, speed)
+    check_page_range(pdf_path, pdf_from, pdf_to)
+    pages = get_page_index(pdf_path).iter_texts(pdf_from, pdf_to)
+    if clean_text:
+        pages = TextCleaner().clean(pages)
+    max_chars = min(max(int(seconds * CHARS_PER_SECOND * speed), 1), MAX_INPUT_CHARS)
+    text = next(iter_sentence_chunks(pages, max_chars), None)
+    if text is None:
+        raise ValueError("There is no text to preview in these pages.")
+
+    scheduler = RequestScheduler(max_concurrency=1, rate_limit=backend.rate_limited)
+    return synthesize_text(backend, scheduler, text, output_file_path, voice, model,
+                           SynthesisCache(), speed=speed)
+
+
+def _append_output_range(output, chunk, source_path):
+    """
+    Appends another copy of an already appended chunk's audio, read back from the
+    job's output file at source_path.
     """
-    Main function to convert a PDF file to an MP3 file.
+    with open(source_path, "rb") as source:
+        source.seek(chunk["offset"])
+        output.write(source.read(chunk["length"]))
+
+
+def get_estimate(pdf_path, pdf_from, pdf_to, backend="openai", model=None, speed=1.0):
+    """
+    Estimates the cost and length of converting a page range of a PDF file. No audio
+    is synthesized.
+
+    Pages that have not been extracted before are extracted and stored in the PDF's
+    page index (see page_index), so estimating another range of the same file, or
+    converting it afterwards, reads them from there instead of extracting them again.
 
     Args:
     - pdf_path (str): Path to the input PDF file.
-    - output_mp3_path (str): Path where the output MP3 file will be saved.
+    - pdf_from (int): First page to convert (zero-based, inclusive).
+    - pdf_to (int): Last page to convert (zero-based, inclusive).
+    - backend (str or TTSBackend): The speech engine the price is for. Local engines
+      cost nothing. Default is "openai".
+    - model (str): The model the price is for. Defaults to the engine's first model.
+    - speed (float): How fast the conversion speaks, 1.0 being normal speed. The
+      length of the audio is shorter the faster it speaks.
+
+    Returns:
+    - dict: "characters" billed, number of "chunks" (API requests), "price_cents" and
+      "duration_seconds" of the resulting audio, and "removed_characters" that text
+      cleanup and "repeated_characters" that reusing the audio of repeated chunks keep
+      from being billed.
+
+    Raises:
+    - ValueError: If the page range is not within the PDF.
     """
-    try:
-        # split pdf by page
-        split_pdf_file_path = split_pdf(pdf_path, pdf_from, pdf_to)
-        # Convert PDF to text
-        txt_path = split_pdf_file_path.replace('.pdf', '.txt')
-        pdf_to_text(split_pdf_file_path, txt_path)
-
-        # Split the text file into chunks
-        chunk_files = split_text_file_into_chunks(txt_path)
-        total_price = 0
-        for file in chunk_files:
-            with open(file, 'r') as f:
-                total_price += calculate_price_from_file(file)
-
-        return total_price
-    except Exception as e:
-        raise e
+    backend = get_backend(backend)
+    check_page_range(pdf_path, pdf_from, pdf_to)
+    estimate = get_estimator(pdf_path).estimate(pdf_from, pdf_to, speed=speed)
+    estimate["price_cents"] = backend.price_cents(estimate["characters"],
+                                                  model or backend.models[0])
+    return estimate
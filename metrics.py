@@ -0,0 +1,270 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class MemorySink:
+    """
+    Keeps every metrics record in a list, for tests, benchmarks and the GUI.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    """
+    Appends every metrics record to a file as one JSON object per line.
+
+    Args:
+    - path (str): The file to append to. Created if it does not exist.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def percentile(values, fraction):
+    """
+    Returns the nearest-rank percentile of a list of numbers, or None if it is empty.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+class Metrics:
+    """
+    Collects wall time and counters for each stage of a conversion, and latency
+    samples for its API requests.
+
+    Stage times are exclusive: while a stage runs inside another on the same thread,
+    such as extraction running inside the chunker's call for more text, its time is
+    counted once, for the inner stage only. Stages running on different threads, like
+    the synthesis workers, are timed separately, so stage times can add up to more
+    than the conversion's wall time.
+
+    Records are sent to every sink as they happen, and report() sends the totals.
+
+    Args:
+    - sinks (list): Objects with write(record) and close() methods, such as
+      JsonLinesSink and MemorySink. Records are only aggregated when empty.
+    """
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self.start = time.monotonic()
+        self.stages = {}  # name -> {"seconds", "calls", and any counters}
+        self.latencies = {}  # name -> seconds of every sample
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        """
+        Sends a record with the seconds elapsed since the metrics were created.
+        """
+        if not self.sinks:
+            return
+        record = {"event": event, "elapsed": round(time.monotonic() - self.start, 6), **fields}
+        for sink in self.sinks:
+            sink.write(record)
+
+    def count(self, stage, **counters):
+        """
+        Adds to a stage's counters, such as characters or bytes handled.
+        """
+        with self._lock:
+            totals = self.stages.setdefault(stage, {"seconds": 0.0, "calls": 0})
+            for name, value in counters.items():
+                totals[name] = totals.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """
+        Records one latency sample, such as the duration of one API request.
+        """
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    @contextmanager
+    def stage(self, name, **counters):
+        """
+        Times the code inside the with block as one call of a stage.
+
+        Yields:
+        - dict: Counters to add to once the stage is done, for amounts only known at
+          the end, like the bytes a request returned.
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        frame = {"child_seconds": 0.0}
+        stack.append(frame)
+        extra = dict(counters)
+        start = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            total = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                stack[-1]["child_seconds"] += total
+            seconds = total - frame["child_seconds"]
+            with self._lock:
+                totals = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+                totals["seconds"] += seconds
+                totals["calls"] += 1
+                for counter, value in extra.items():
+                    totals[counter] = totals.get(counter, 0) + value
+
+    def timed(self, name, iterable, counters=None):
+        """
+        Yields the items of iterable, timing each step of it as a call of a stage.
+
+        Args:
+        - name (str): The stage.
+        - iterable (iterable): Items to pass through, such as page texts.
+        - counters (callable): Called with each item to return the counters to add
+          for it, like {"chars": len(text)}.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as extra:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                if counters is not None:
+                    extra.update(counters(item))
+            yield item
+
+    def report(self):
+        """
+        Returns the totals so far and sends them to the sinks as a "report" record.
+
+        Returns:
+        - dict: The "wall_seconds" since the metrics were created, each stage's
+          "seconds", "calls" and counters, and the "count", "p50", "p90", "p99" and
+          "max" of each latency.
+        """
+        with self._lock:
+            stages = {name: {**totals, "seconds": round(totals["seconds"], 6)}
+                      for name, totals in self.stages.items()}
+            latencies = {
+                name: {"count": len(values),
+                       "p50": percentile(values, 0.5),
+                       "p90": percentile(values, 0.9),
+                       "p99": percentile(values, 0.99),
+                       "max": max(values)}
+                for name, values in self.latencies.items()}
+        report = {"wall_seconds": round(time.monotonic() - self.start, 6), "stages": stages,
+                  "latency": latencies}
+        self.emit("report", **report)
+        return report
+
+    def summary(self):
+        """
+        Returns a short human readable breakdown of where the time went.
+        """
+        report = self.report()
+        lines = [f"Stages ({report['wall_seconds']:.2f}s wall time):"]
+        for name, totals in sorted(report["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            counters = ", ".join(f"{counter} {value}" for counter, value in totals.items()
+                                 if counter not in ("seconds", "calls"))
+            lines.append(f"  {name}: {totals['seconds']:.2f}s over {totals['calls']} calls"
+                         + (f", {counters}" if counters else ""))
+        for name, latency in report["latency"].items():
+            lines.append(f"  {name} latency: p50 {latency['p50']:.2f}s, p90 {latency['p90']:.2f}s, "
+                         f"p99 {latency['p99']:.2f}s, max {latency['max']:.2f}s "
+                         f"over {latency['count']} requests")
+        return "\n".join(lines)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+@contextmanager
+def profiling(mode, output_path=None, metrics=None, top=20):
+    """
+    Profiles the code inside the with block.
+
+    - "cprofile": records a cProfile of the calling thread, which runs extraction,
+      cleanup, chunking and stitching. Synthesis runs on worker threads and is not
+      included; its time shows up in the stage metrics instead. The stats are saved
+      to output_path (default conversion.prof) for tools like snakeviz, and the top
+      functions by cumulative time are printed.
+    - "tracemalloc": traces memory allocations from every thread and prints the lines
+      that allocated the most memory still in use at the end, and the peak.
+    - None: does nothing.
+
+    Args:
+    - mode (str): "cprofile", "tracemalloc" or None.
+    - output_path (str): Where to save the cProfile stats.
+    - metrics (Metrics): Also sends a "profile" record with the results to its sinks.
+    - top (int): Number of functions or lines to print.
+    """
+    if mode is None:
+        yield
+        return
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            output_path = output_path or "conversion.prof"
+            profiler.dump_stats(output_path)
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
+            print(f"Profile saved to {output_path}")
+            if metrics is not None:
+                metrics.emit("profile", mode=mode, path=output_path)
+        return
+    if mode == "tracemalloc":
+        already_tracing = tracemalloc.is_tracing()
+        if not already_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            if not already_tracing:
+                tracemalloc.stop()
+            statistics = snapshot.statistics("lineno")[:top]
+            print(f"Peak traced memory: {peak / 1e6:.1f} MB")
+            for statistic in statistics:
+                print(f"  {statistic}")
+            if metrics is not None:
+                metrics.emit("profile", mode=mode, peak_bytes=peak,
+                             top=[str(statistic) for statistic in statistics])
+        return
+    raise ValueError(f"Unknown profiling mode: {mode}")
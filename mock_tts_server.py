@@ -0,0 +1,139 @@
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A single silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz, mono).
+# Every frame holds 1152 samples, roughly 26 ms of audio.
+SILENT_FRAME = b"\xff\xfb\x90\xc0" + bytes(413)
+FRAME_SECONDS = 1152 / 44100
+CHARS_PER_SECOND = 15
+# An ADTS AAC-LC frame header (24 kHz, mono) with 6 bytes of payload, 1024 samples long.
+# The payload is not real audio; the frames only have the shape of the API's AAC.
+AAC_FRAME = b"\xff\xf1\x58\x40\x01\xbf\xfc" + bytes(6)
+AAC_FRAME_SECONDS = 1024 / 24000
+# The API's raw PCM: 24 kHz, 16-bit, mono.
+PCM_BYTES_PER_SECOND = 24000 * 2
+CONTENT_TYPES = {"mp3": "audio/mpeg", "aac": "audio/aac", "pcm": "audio/pcm"}
+
+
+def fake_mp3(text):
+    """
+    Builds a silent MP3 whose duration roughly matches how long the text would take to read.
+
+    Args:
+    - text (str): The text that would have been spoken.
+
+    Returns:
+    - bytes: The MP3 data.
+    """
+    frames = max(1, int(len(text) / CHARS_PER_SECOND / FRAME_SECONDS))
+    return SILENT_FRAME * frames
+
+
+def fake_audio(text, response_format="mp3"):
+    """
+    Builds audio in one of the API's formats ("mp3", "aac" or "pcm") whose duration
+    roughly matches how long the text would take to read. See fake_mp3.
+    """
+    seconds = len(text) / CHARS_PER_SECOND
+    if response_format == "aac":
+        return AAC_FRAME * max(1, int(seconds / AAC_FRAME_SECONDS))
+    if response_format == "pcm":
+        return bytes(max(2, int(seconds * PCM_BYTES_PER_SECOND) // 2 * 2))
+    return fake_mp3(text)
+
+
+class MockTTSHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests, as the real API does.
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if not self.path.endswith("/audio/speech"):
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            over_limit = server.max_concurrent and server.in_flight > server.max_concurrent
+        try:
+            time.sleep(server.latency)
+            if over_limit:
+                self._send_error(429, "Rate limit reached")
+            elif server.random.random() < server.error_rate:
+                self._send_error(server.random.choice([429, 500, 503]), "Injected error")
+            else:
+                response_format = body.get("response_format", "mp3")
+                audio = fake_audio(body.get("input", ""), response_format)
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 CONTENT_TYPES.get(response_format, "audio/mpeg"))
+                self.send_header("Content-Length", str(len(audio)))
+                self.end_headers()
+                self.wfile.write(audio)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _send_error(self, status, message):
+        payload = json.dumps({"error": {"message": message, "type": "mock_error"}}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_server(port=0, latency=0.5, error_rate=0.0, max_concurrent=None, seed=None):
+    """
+    Starts a local server that imitates the OpenAI speech endpoint on a background thread.
+
+    Point the OpenAI client at it by setting OPENAI_BASE_URL to the returned base URL.
+
+    Args:
+    - port (int): Port to listen on. 0 picks a free port.
+    - latency (float): Seconds to wait before answering each request.
+    - error_rate (float): Fraction of requests answered with a random 429, 500 or 503.
+    - max_concurrent (int): Requests above this many in flight get a 429. None for no limit.
+    - seed (int): Seeds the choice of failing requests, so runs can be repeated.
+
+    Returns:
+    - tuple: The running server and its base URL.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockTTSHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.error_rate = error_rate
+    server.max_concurrent = max_concurrent
+    server.in_flight = 0
+    server.random = random.Random(seed)
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    return server, base_url
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    error_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    server, base_url = start_mock_server(port, latency, error_rate, seed=seed)
+    print(f"Mock TTS server listening on {base_url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
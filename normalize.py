@@ -0,0 +1,172 @@
+import re
+from collections import Counter, deque
+
+# Lines at the top and bottom of each page that may be running headers or footers.
+EDGE_LINES = 3
+# Pages compared with each page when looking for repeated headers and footers.
+WINDOW_PAGES = 10
+# A header or footer line must appear on at least this many pages of the window.
+MIN_REPEATS = 3
+
+_DIGITS = re.compile(r"\d+")
+_PAGE_NUMBER = re.compile(r"^((?i:page)\s+)?(\d+|[ivxlcdm]+|[IVXLCDM]+)(\s+of\s+\d+)?$")
+# A well-formed roman numeral, in lower case.
+_ROMAN = re.compile(r"^(?=.)m{0,3}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})$")
+_HYPHENATED = re.compile(r"(\w)-\n[ \t]*([a-z])")
+_TRAILING_HYPHEN = re.compile(r"(\w)-\s*$")
+_LEADING_WORD = re.compile(r"^\s*([a-z]\S*)\s*")
+# Control characters other than whitespace, surrogates and private use glyphs
+# (icons embedded by the PDF's fonts), none of which can be spoken.
+_UNSPEAKABLE = re.compile(
+    "[\x00-\x08\x0e-\x1f\x7f-\x84\x86-\x9f\ud800-\udfff\ue000-\uf8ff\U000f0000-\U0010ffff]")
+
+
+def _signature(line):
+    # Page numbers and dates change from page to page, so digits are ignored.
+    return _DIGITS.sub("#", " ".join(line.split()).lower())
+
+
+def _page_number(line):
+    """
+    Returns "arabic" or "roman" if a line looks like a page number, or None.
+    """
+    match = _PAGE_NUMBER.match(line.strip())
+    if match is None:
+        return None
+    number = match.group(2)
+    if number.isdigit():
+        return "arabic"
+    return "roman" if _ROMAN.match(number.lower()) else None
+
+
+def _billable(text):
+    return len(" ".join(text.split()))
+
+
+class TextCleaner:
+    """
+    Cleans extracted page text before it is chunked and synthesized.
+
+    - Running headers, footers and page numbers are removed. A line near the top or
+      bottom of a page is treated as one when the same line, ignoring digits, appears
+      near the edge of at least MIN_REPEATS of the WINDOW_PAGES surrounding pages.
+      A lone number is always a page number, but a lone roman numeral only when
+      another of the surrounding pages has one at the same edge, since words such as
+      "I" or "mix" are spelled the same way.
+    - Words hyphenated across a line or page break are rejoined.
+    - Runs of spaces are collapsed and unspeakable characters removed, keeping blank
+      lines between paragraphs.
+
+    The counts of what was removed are kept in stats, including an estimate of the
+    billable characters saved.
+    """
+
+    def __init__(self, window=WINDOW_PAGES, min_repeats=MIN_REPEATS, edge_lines=EDGE_LINES):
+        self.window = window
+        self.min_repeats = min_repeats
+        self.edge_lines = edge_lines
+        self.stats = {"pages": 0, "boilerplate_lines": 0, "hyphens_joined": 0,
+                      "chars_removed": 0}
+
+    def _edges(self, lines):
+        indexes = [i for i, line in enumerate(lines) if line.strip()]
+        top = indexes[:self.edge_lines]
+        edges = {}
+        for i in top + indexes[-self.edge_lines:]:
+            if _page_number(lines[i]) == "roman":
+                # Roman page numbers are matched by the edge they are at, not their value.
+                edges[i] = "<roman top>" if i in top else "<roman bottom>"
+            else:
+                edges[i] = _signature(lines[i])
+        return edges
+
+    def _is_boilerplate(self, line, signature, counts):
+        if counts[signature] >= self.min_repeats:
+            return True
+        page_number = _page_number(line)
+        return page_number == "arabic" or (page_number == "roman" and counts[signature] >= 2)
+
+    def _strip_boilerplate(self, lines, edges, counts):
+        kept = []
+        for i, line in enumerate(lines):
+            signature = edges.get(i)
+            if signature is not None and self._is_boilerplate(line, signature, counts):
+                self.stats["boilerplate_lines"] += 1
+                self.stats["chars_removed"] += _billable(line) + 1
+                continue
+            kept.append(line)
+        return kept
+
+    def _tidy(self, lines):
+        text = "\n".join(lines)
+        text, joined = _HYPHENATED.subn(r"\1\2", text)
+        self.stats["hyphens_joined"] += joined
+        self.stats["chars_removed"] += joined
+
+        speakable = _UNSPEAKABLE.sub("", text)
+        self.stats["chars_removed"] += _billable(text) - _billable(speakable)
+
+        paragraphs = []
+        for paragraph in re.split(r"\n\s*\n", speakable):
+            paragraph_lines = [" ".join(line.split()) for line in paragraph.split("\n")]
+            paragraph = "\n".join(line for line in paragraph_lines if line)
+            if paragraph:
+                paragraphs.append(paragraph)
+        return "\n\n".join(paragraphs)
+
+    def _join_pages(self, previous, text):
+        """
+        Rejoins a word hyphenated across a page break by moving its second half from
+        the start of text to the end of previous.
+        """
+        word = _LEADING_WORD.match(text)
+        if word is None or not _TRAILING_HYPHEN.search(previous):
+            return previous, text
+        self.stats["hyphens_joined"] += 1
+        self.stats["chars_removed"] += 1
+        previous = _TRAILING_HYPHEN.sub(lambda match: match.group(1) + word.group(1), previous)
+        return previous, text[word.end():]
+
+    def clean(self, texts):
+        """
+        Yields the cleaned text of each page in a stream of page texts.
+
+        Pages are yielded in order with a look-ahead of half a window, so the stream
+        stays lazy however many pages there are.
+
+        Args:
+        - texts (iterable of str): Raw page texts, such as from PageIndex.iter_texts.
+
+        Yields:
+        - str: The cleaned text of one page.
+        """
+        lookahead = self.window // 2
+        pending = deque()  # (lines, edges) of pages not yet cleaned, oldest first
+        recent = deque(maxlen=self.window - lookahead)  # edges of cleaned pages
+        previous = None
+
+        def clean_next():
+            lines, edges = pending.popleft()
+            counts = Counter()
+            for page_edges in list(recent) + [edges] + [entry[1] for entry in pending]:
+                counts.update(set(page_edges.values()))
+            recent.append(edges)
+            self.stats["pages"] += 1
+            return self._tidy(self._strip_boilerplate(lines, edges, counts))
+
+        def emit(text):
+            nonlocal previous
+            if previous is not None:
+                previous, text = self._join_pages(previous, text)
+                yield previous
+            previous = text
+
+        for text in texts:
+            lines = text.split("\n")
+            pending.append((lines, self._edges(lines)))
+            if len(pending) > lookahead:
+                yield from emit(clean_next())
+        while pending:
+            yield from emit(clean_next())
+        if previous is not None:
+            yield previous
@@ -0,0 +1,258 @@
+import multiprocessing
+import os
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import fitz
+
+from jobs import file_hash
+
+INDEX_PATH = os.getenv("PAGE_INDEX_PATH", "cache/page_index.sqlite")
+
+# Processes used to extract pages that are not indexed yet.
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", min(os.cpu_count() or 1, 4)))
+# Below this many pages to extract, starting worker processes costs more than it saves.
+PARALLEL_MIN_PAGES = 64
+
+# Bumped whenever what is stored for a page changes, so older indexes are rebuilt.
+INDEX_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    doc_hash TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    chars INTEGER NOT NULL,
+    words INTEGER NOT NULL,
+    blocks INTEGER NOT NULL,
+    images INTEGER NOT NULL,
+    width REAL NOT NULL,
+    height REAL NOT NULL,
+    PRIMARY KEY (doc_hash, page)
+);
+CREATE TABLE IF NOT EXISTS documents (
+    doc_hash TEXT PRIMARY KEY,
+    page_count INTEGER NOT NULL
+);
+"""
+
+_COLUMNS = ("page", "text", "chars", "words", "blocks", "images", "width", "height")
+
+
+def extract_page(page):
+    """
+    Extracts the text of a page along with its character and word counts and basic
+    layout information. Text blocks are separated by a blank line, which is how the
+    chunker recognises paragraph breaks.
+
+    Returns:
+    - dict: The page's "page" number, "text", "chars", "words", text "blocks",
+      "images", and "width" and "height" in points.
+    """
+    blocks = [block for block in page.get_text("blocks") if block[6] == 0]
+    text = "\n".join(block[4] for block in blocks)
+    return {
+        "page": page.number,
+        "text": text,
+        "chars": len(text),
+        "words": len(text.split()),
+        "blocks": len(blocks),
+        "images": len(page.get_images()),
+        "width": page.rect.width,
+        "height": page.rect.height,
+    }
+
+
+def _extract_pages(pdf_path, page_numbers):
+    """
+    Extracts a list of pages with a document handle of its own. Runs in worker processes.
+    """
+    with fitz.open(pdf_path) as doc:
+        return [extract_page(doc[page_number]) for page_number in page_numbers]
+
+
+class PageIndex:
+    """
+    A persistent per-document index of extracted page text, keyed by the hash of the
+    PDF file so that copies and renames of the same book share one index.
+
+    Pages are extracted the first time they are asked for and read back from the
+    index after that, so repeated estimates, conversions and previews of the same
+    book only ever extract each page once.
+
+    Args:
+    - pdf_path (str): Path to the PDF file.
+    - index_path (str): SQLite database holding the index. Defaults to PAGE_INDEX_PATH
+      or cache/page_index.sqlite.
+    """
+
+    def __init__(self, pdf_path, index_path=INDEX_PATH):
+        self.pdf_path = pdf_path
+        self.index_path = index_path
+        self.doc_hash = file_hash(pdf_path)
+        self._lock = threading.Lock()
+        directory = os.path.dirname(index_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version != INDEX_VERSION:
+                connection.executescript(
+                    "DROP TABLE IF EXISTS pages; DROP TABLE IF EXISTS documents;")
+                connection.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+            connection.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.index_path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @property
+    def page_count(self):
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT page_count FROM documents WHERE doc_hash = ?", (self.doc_hash,)
+            ).fetchone()
+        if row is not None:
+            return row[0]
+        with fitz.open(self.pdf_path) as doc:
+            count = len(doc)
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?)", (self.doc_hash, count))
+        return count
+
+    def _load(self, from_page, to_page):
+        with self._connect() as connection:
+            rows = connection.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM pages "
+                "WHERE doc_hash = ? AND page BETWEEN ? AND ?",
+                (self.doc_hash, from_page, to_page)).fetchall()
+        return {row[0]: dict(zip(_COLUMNS, row)) for row in rows}
+
+    def _store(self, records):
+        with self._connect() as connection:
+            connection.executemany(
+                f"INSERT OR REPLACE INTO pages VALUES (?, {', '.join('?' * len(_COLUMNS))})",
+                [(self.doc_hash, *(record[column] for column in _COLUMNS))
+                 for record in records])
+
+    def _indexed_pages(self, from_page, to_page):
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT page FROM pages WHERE doc_hash = ? AND page BETWEEN ? AND ?",
+                (self.doc_hash, from_page, to_page)).fetchall()
+        return {row[0] for row in rows}
+
+    def iter_pages(self, from_page, to_page, batch_size=16, workers=None):
+        """
+        Yields the index record of each page in a range, extracting and storing the
+        pages that are not indexed yet. Records are yielded in page order as soon as
+        they are available, so a long range is never held in memory at once.
+
+        When at least PARALLEL_MIN_PAGES pages need extracting, the batches are split
+        across worker processes, each with its own document handle. The workers run
+        up to two batches each ahead of the pages being consumed. They are spawned
+        rather than forked, since the calling process may be running other threads.
+
+        Args:
+        - from_page (int): The first page (zero-based indexing).
+        - to_page (int): The last page (zero-based indexing, inclusive).
+        - batch_size (int): Pages read, extracted or written to the index at a time.
+        - workers (int): Extraction processes to use. Defaults to EXTRACTION_WORKERS;
+          1 extracts in this process.
+
+        Yields:
+        - dict: A page record, as returned by extract_page.
+
+        Raises:
+        - ValueError: If from_page is negative.
+        """
+        if from_page < 0:
+            raise ValueError(f"Pages are numbered from 0, not {from_page}")
+        workers = EXTRACTION_WORKERS if workers is None else workers
+        to_page = min(to_page, self.page_count - 1)
+        indexed = self._indexed_pages(from_page, to_page)
+        batches = []
+        for start in range(from_page, to_page + 1, batch_size):
+            end = min(start + batch_size - 1, to_page)
+            missing = [page for page in range(start, end + 1) if page not in indexed]
+            batches.append((start, end, missing))
+
+        to_extract = sum(len(missing) for _, _, missing in batches)
+        if workers > 1 and to_extract >= PARALLEL_MIN_PAGES:
+            pool = ProcessPoolExecutor(max_workers=workers,
+                                       mp_context=multiprocessing.get_context("spawn"))
+            pending = deque()
+
+            def collect():
+                start, end, future = pending.popleft()
+                extracted = future.result() if future is not None else []
+                return self._merge(start, end, extracted)
+
+            try:
+                for start, end, missing in batches:
+                    pending.append((start, end, pool.submit(_extract_pages, self.pdf_path, missing)
+                                    if missing else None))
+                    if len(pending) >= 2 * workers:
+                        yield from collect()
+                while pending:
+                    yield from collect()
+            finally:
+                pool.shutdown(cancel_futures=True)
+            return
+
+        doc = None
+        try:
+            for start, end, missing in batches:
+                if missing and doc is None:
+                    doc = fitz.open(self.pdf_path)
+                extracted = [extract_page(doc[page]) for page in missing]
+                yield from self._merge(start, end, extracted)
+        finally:
+            if doc is not None:
+                doc.close()
+
+    def _merge(self, start, end, extracted):
+        """
+        Stores newly extracted pages and yields them, along with the indexed pages of
+        the same batch, in page order.
+        """
+        records = self._load(start, end) if len(extracted) < end - start + 1 else {}
+        if extracted:
+            with self._lock:
+                self._store(extracted)
+            for record in extracted:
+                records[record["page"]] = record
+        for page_number in range(start, end + 1):
+            yield records[page_number]
+
+    def iter_texts(self, from_page, to_page):
+        """
+        Yields the text of each page in a range. See iter_pages.
+        """
+        for record in self.iter_pages(from_page, to_page):
+            yield record["text"]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_page_index(pdf_path):
+    """
+    Returns the shared page index for a PDF file, creating a new one if the file has
+    changed since it was last used.
+    """
+    key = (os.path.abspath(pdf_path), os.path.getmtime(pdf_path))
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = PageIndex(pdf_path)
+        return _indexes[key]
@@ -0,0 +1,203 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+import openai
+
+
+def _env_int(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+class RateLimiter:
+    """
+    Keeps the requests and characters sent in the last minute under fixed limits.
+
+    Limits left as None are not enforced.
+    """
+
+    def __init__(self, requests_per_minute=None, chars_per_minute=None, window=60.0):
+        self.requests_per_minute = requests_per_minute
+        self.chars_per_minute = chars_per_minute
+        self.window = window
+        self._sent = deque()  # (timestamp, chars) for every request in the window
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._sent and now - self._sent[0][0] >= self.window:
+            self._chars -= self._sent.popleft()[1]
+
+    def _wait_time(self, now, chars):
+        if self.requests_per_minute and len(self._sent) >= self.requests_per_minute:
+            return self._sent[0][0] + self.window - now
+        if self.chars_per_minute and self._sent and self._chars + chars > self.chars_per_minute:
+            return self._sent[0][0] + self.window - now
+        return 0
+
+    def acquire(self, chars=0):
+        """
+        Blocks until a request of the given size fits in the current window, then records it.
+
+        Args:
+        - chars (int): Number of characters the request will send.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._expire(now)
+                wait = self._wait_time(now, chars)
+                if wait <= 0:
+                    self._sent.append((now, chars))
+                    self._chars += chars
+                    return
+            time.sleep(wait)
+
+
+class AdaptiveLimit:
+    """
+    A concurrency limit that halves when the API throttles and grows back one step
+    after every success_threshold successful requests.
+    """
+
+    def __init__(self, maximum, minimum=1, success_threshold=10):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.success_threshold = success_threshold
+        self.limit = maximum
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.success_threshold and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            self.limit = max(self.minimum, self.limit // 2)
+            self._successes = 0
+
+
+def _is_throttle(error):
+    return isinstance(error, openai.RateLimitError)
+
+
+def _is_retryable(error):
+    # A connection dropped while a streamed response is being read surfaces as the
+    # underlying httpx error rather than an APIConnectionError.
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, httpx.TransportError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return 0
+    try:
+        return float(response.headers.get("retry-after", 0))
+    except ValueError:
+        return 0
+
+
+class RequestScheduler:
+    """
+    Runs TTS requests under a rate limit and an adaptive concurrency limit, retrying
+    throttled (429), server (5xx) and connection errors with jittered exponential backoff.
+
+    One scheduler can be shared by every thread that talks to the API.
+
+    Args:
+    - max_concurrency (int): Upper bound on requests in flight at the same time.
+    - requests_per_minute (int): Requests allowed per minute. Defaults to TTS_REQUESTS_PER_MINUTE.
+    - chars_per_minute (int): Input characters allowed per minute. Defaults to TTS_CHARS_PER_MINUTE.
+    - max_retries (int): Retries per request before giving up. Default is 6.
+    - base_delay (float): Backoff in seconds before the first retry. Default is 1.
+    - max_delay (float): Longest backoff in seconds between two attempts, including a
+      Retry-After asked for by the server. Default is 60.
+    - rate_limit (bool): Enforce the per-minute limits. Turn it off for local engines,
+      which have none. Default is True.
+    """
+
+    def __init__(self, max_concurrency=4, requests_per_minute=None, chars_per_minute=None,
+                 max_retries=6, base_delay=1.0, max_delay=60.0, rate_limit=True):
+        if rate_limit:
+            self.rate_limiter = RateLimiter(
+                requests_per_minute or _env_int("TTS_REQUESTS_PER_MINUTE"),
+                chars_per_minute or _env_int("TTS_CHARS_PER_MINUTE"))
+        else:
+            self.rate_limiter = RateLimiter()
+        self.concurrency = AdaptiveLimit(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "failed": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        # The server's Retry-After is honoured, but never beyond max_delay.
+        return min(max(delay, _retry_after(error)), self.max_delay)
+
+    def run(self, func, chars=0):
+        """
+        Calls func once it is allowed to, retrying it until it succeeds or runs out of retries.
+
+        Args:
+        - func (callable): Sends one request. Called with no arguments.
+        - chars (int): Number of characters the request sends, for the per-minute limit.
+
+        Returns:
+        - The value returned by func.
+
+        Raises:
+        - Exception: The last error from func if it is not retryable or all retries failed.
+        """
+        attempt = 0
+        while True:
+            self.concurrency.acquire()
+            self.rate_limiter.acquire(chars)
+            self._count("requests")
+            try:
+                result = func()
+            except Exception as e:
+                if not _is_retryable(e) or attempt >= self.max_retries:
+                    self._count("failed")
+                    raise
+                if _is_throttle(e):
+                    self._count("throttled")
+                    self.concurrency.on_throttle()
+                delay = self._backoff(attempt, e)
+            else:
+                self.concurrency.on_success()
+                return result
+            finally:
+                self.concurrency.release()
+
+            self._count("retries")
+            attempt += 1
+            time.sleep(delay)
@@ -0,0 +1,222 @@
+import os
+import shutil
+import subprocess
+import threading
+
+from api_client import get_client
+
+# Number of speech requests sent to the API at the same time.
+DEFAULT_MAX_WORKERS = 4
+
+# Bytes of audio written at a time as it arrives.
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+class TTSBackend:
+    """
+    A speech engine that chunks are synthesized with. Subclasses set the attributes
+    below and implement synthesize.
+
+    Attributes:
+    - name (str): The name the engine is selected by, see get_backend.
+    - voices (tuple of str): Voices it speaks with, the first being the default.
+    - models (tuple of str): Models it accepts, the first being the default. Every
+      engine has its own model names, so cached audio and jobs of different engines
+      never mix.
+    - formats (tuple of str): Audio formats it can produce.
+    - min_speed, max_speed (float): The range of speeds, 1.0 being normal speed.
+    - rate_limited (bool): Whether requests count against API rate limits, so the
+      per-minute limits of RequestScheduler should apply.
+    - max_workers (int): Chunks synthesized at the same time by default.
+    """
+
+    name = None
+    voices = ()
+    models = ()
+    formats = ("mp3",)
+    min_speed = 1.0
+    max_speed = 1.0
+    rate_limited = False
+    max_workers = DEFAULT_MAX_WORKERS
+
+    def check(self, voice, model, response_format="mp3", speed=1.0):
+        """
+        Checks that the engine supports a combination of settings before any work is
+        done with them.
+
+        Raises:
+        - ValueError: If the model, format or speed is not supported.
+        """
+        if model not in self.models:
+            raise ValueError(f"The {self.name} engine has no model {model!r}; "
+                             f"use one of {', '.join(self.models)}")
+        if response_format not in self.formats:
+            raise ValueError(f"The {self.name} engine cannot produce {response_format!r} "
+                             f"audio; use one of {', '.join(self.formats)}")
+        if not self.min_speed <= speed <= self.max_speed:
+            raise ValueError(f"The {self.name} engine's speed must be between "
+                             f"{self.min_speed} and {self.max_speed}")
+
+    def price_cents(self, chars, model):
+        """
+        Returns the price in cents of synthesizing chars characters with a model.
+        """
+        return 0.0
+
+    def synthesize(self, text, file, voice, model, response_format="mp3", speed=1.0):
+        """
+        Speaks text and writes the audio to file as it is produced.
+
+        Called from several threads at once. Errors are raised as they are, so the
+        scheduler can tell which ones are worth retrying.
+
+        Args:
+        - text (str): The text to speak.
+        - file (file): An open binary file to write the audio to.
+        - voice (str): The voice to speak with.
+        - model (str): The model to use.
+        - response_format (str): The audio format to produce.
+        - speed (float): How fast to speak, 1.0 being normal speed.
+        """
+        raise NotImplementedError
+
+
+class OpenAIBackend(TTSBackend):
+    """
+    Sends chunks to the OpenAI speech API through the shared client (see
+    api_client.get_client) and streams the audio back.
+
+    Args:
+    - client (OpenAI): The client to send requests with. Defaults to the shared one.
+    """
+
+    name = "openai"
+    voices = ("alloy", "echo", "fable", "onyx", "nova", "shimmer")
+    models = ("tts-1", "tts-1-hd")
+    formats = ("mp3", "opus", "aac", "flac", "wav", "pcm")
+    min_speed = 0.25
+    max_speed = 4.0
+    rate_limited = True
+    # Price of each model in cents per million characters.
+    cents_per_million_chars = {"tts-1": 1500, "tts-1-hd": 3000}
+
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else get_client()
+
+    def price_cents(self, chars, model):
+        return chars / 1000000 * self.cents_per_million_chars[model]
+
+    def synthesize(self, text, file, voice, model, response_format="mp3", speed=1.0):
+        with self.client.audio.speech.with_streaming_response.create(
+            model=model,
+            voice=voice,
+            input=text,
+            response_format=response_format,
+            speed=speed,
+        ) as response:
+            for data in response.iter_bytes(STREAM_CHUNK_BYTES):
+                file.write(data)
+
+
+class EspeakBackend(TTSBackend):
+    """
+    Speaks with eSpeak NG on this machine. The voice is robotic, but there is no
+    per-character cost, no network latency and no rate limit, which suits drafts and
+    checking the text of a long book before paying for it.
+
+    Every chunk runs in its own espeak-ng process piped into an ffmpeg process that
+    encodes it, so chunks synthesized at the same time run on separate cores. Needs
+    espeak-ng (or espeak) and ffmpeg on the PATH. Voices are eSpeak language codes;
+    espeak-ng --voices lists them all.
+    """
+
+    name = "espeak"
+    voices = ("en-us", "en-gb", "en-gb-scotland", "en-029", "fr", "de", "es", "it")
+    models = ("espeak",)
+    formats = ("mp3", "aac", "pcm")
+    min_speed = 0.5
+    max_speed = 2.5
+    max_workers = os.cpu_count() or 1
+    # eSpeak's normal speaking rate.
+    words_per_minute = 175
+    # ffmpeg arguments that encode each format. PCM matches the speech API's.
+    encoder_arguments = {
+        "mp3": ["-f", "mp3"],
+        "aac": ["-c:a", "aac", "-f", "adts"],
+        "pcm": ["-ar", "24000", "-ac", "1", "-f", "s16le"],
+    }
+
+    def _command(self):
+        for command in ("espeak-ng", "espeak"):
+            if shutil.which(command) is not None:
+                return command
+        raise RuntimeError("espeak-ng is not installed")
+
+    def synthesize(self, text, file, voice, model, response_format="mp3", speed=1.0):
+        command = self._command()
+        if shutil.which("ffmpeg") is None:
+            raise RuntimeError("ffmpeg is not installed")
+
+        speaker = subprocess.Popen(
+            [command, "--stdout", "--stdin", "-v", voice,
+             "-s", str(round(self.words_per_minute * speed))],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        encoder = subprocess.Popen(
+            ["ffmpeg", "-loglevel", "error", "-f", "wav", "-i", "pipe:0",
+             *self.encoder_arguments[response_format], "pipe:1"],
+            stdin=speaker.stdout, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        # Only the encoder reads the speech, so espeak stops if the encoder fails.
+        speaker.stdout.close()
+        # The text is fed from another thread, so espeak can never block on it while
+        # the encoded audio waits to be read here.
+        writer = threading.Thread(target=_write_and_close, args=(speaker.stdin, text),
+                                  daemon=True)
+        writer.start()
+        try:
+            for data in iter(lambda: encoder.stdout.read(STREAM_CHUNK_BYTES), b""):
+                file.write(data)
+        finally:
+            encoder.stdout.close()
+            speaker_status = speaker.wait()
+            encoder_status = encoder.wait()
+            writer.join()
+        if speaker_status != 0:
+            raise RuntimeError(f"{command} failed with exit status {speaker_status}")
+        if encoder_status != 0:
+            raise RuntimeError(f"ffmpeg failed with exit status {encoder_status}")
+
+
+def _write_and_close(stream, text):
+    try:
+        stream.write(text.encode("utf-8"))
+        stream.close()
+    except OSError:
+        # The process exited early; its exit status reports why.
+        pass
+
+
+BACKENDS = {backend.name: backend for backend in (OpenAIBackend, EspeakBackend)}
+
+
+def get_backend(backend="openai"):
+    """
+    Returns the speech engine with the given name, or backend itself if it already is one.
+
+    Args:
+    - backend (str or TTSBackend): "openai" or "espeak", or an engine.
+
+    Returns:
+    - TTSBackend: The engine.
+
+    Raises:
+    - ValueError: If there is no engine with that name.
+    """
+    if isinstance(backend, TTSBackend):
+        return backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown TTS engine: {backend}; use one of {', '.join(BACKENDS)}")
+    return BACKENDS[backend]()